@@ -0,0 +1,195 @@
+"""
+Vectorized time-series kernels over cumulative covid counts
+Every function takes a 1-D array (one series) or a 2-D date x state array and works along
+axis 0, so all states are computed in one pass.
+"""
+import numpy as np
+
+
+def to_matrix(df, value, index='date', columns='state', fill=False, order=None, rows=None):
+    """Pivots long-format `df` into a dense `index` x `columns` float array of `value`
+    Returns (index labels, column labels, array); missing cells are NaN, or with `fill`, carried
+    forward from the last report and 0 before the first one, as cumulative counts imply.
+    `order` lists the columns to return, in that order, and `rows` the index labels.
+    """
+    wide = df.pivot(index=index, columns=columns, values=value)
+    if order is not None:
+        wide = wide.reindex(columns=order)
+    if rows is not None:
+        wide = wide.reindex(index=rows)
+    if fill:
+        wide = wide.ffill().fillna(0)
+    return wide.index.to_numpy(), wide.columns.to_numpy(), wide.to_numpy(dtype=np.float64)
+
+
+def daily_diff(cumulative):
+    """Returns day-over-day differences; the first day keeps its cumulative value, as in
+    `utils.daily_increase`
+    """
+    cumulative = np.asarray(cumulative)
+    return np.diff(cumulative, axis=0, prepend=np.zeros_like(cumulative[:1]))
+
+
+def _window_bounds(n, window, align):
+    """Returns [start, end) row bounds of each window, clipped to the series"""
+    i = np.arange(n)
+    if align == 'trailing':
+        start = i - window + 1
+    elif align == 'centered':
+        start = i - window // 2
+    elif align == 'forward':
+        start = i
+    else:
+        raise ValueError('align must be trailing, centered or forward, got {}'.format(align))
+    return np.clip(start, 0, n), np.clip(start + window, 0, n)
+
+
+def _window_sums(data, start, end):
+    """Returns the sums of `data` over the rows [start, end) via a prefix sum"""
+    prefix = np.concatenate([np.zeros_like(data[:1]), np.cumsum(data, axis=0)])
+    return prefix[end] - prefix[start]
+
+
+def rolling_sum(data, window=7, align='trailing'):
+    """Returns the sum over each `window`-day window, O(n) via prefix sums
+    `align` is 'trailing' (ending on the day), 'centered', or 'forward' (starting on the day, the
+    behaviour of `utils.moving_average`). Windows are truncated at both ends of the series.
+    A window that contains a NaN day is NaN; the NaN does not spill into the other windows.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    missing = np.isnan(data)
+    start, end = _window_bounds(data.shape[0], window, align)
+    sums = _window_sums(np.where(missing, 0, data), start, end)
+    sums[_window_sums(missing.astype(np.int64), start, end) > 0] = np.nan
+    return sums
+
+
+def rolling_mean(data, window=7, align='trailing'):
+    """Returns the mean over each `window`-day window; see `rolling_sum` for `align`"""
+    data = np.asarray(data, dtype=np.float64)
+    start, end = _window_bounds(data.shape[0], window, align)
+    counts = (end - start).reshape((-1,) + (1,) * (data.ndim - 1))
+    return rolling_sum(data, window, align) / counts
+
+
+def growth_rate(data, periods=1):
+    """Returns the relative change over `periods` days; NaN where undefined"""
+    data = np.asarray(data, dtype=np.float64)
+    rate = np.full_like(data, np.nan)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rate[periods:] = data[periods:] / data[:-periods] - 1
+    rate[~np.isfinite(rate)] = np.nan
+    return rate
+
+
+def doubling_time(cumulative, periods=7):
+    """Returns the days a cumulative count takes to double at the growth seen over the last
+    `periods` days; NaN where there is no growth
+    """
+    ratio = growth_rate(cumulative, periods) + 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        days = periods * np.log(2) / np.log(ratio)
+    days[~(ratio > 1)] = np.nan
+    return days
+
+
+def per_capita(data, population, per=100000):
+    """Returns `data` per `per` residents; `population` has one entry per column (state)"""
+    population = np.asarray(population, dtype=np.float64)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.asarray(data, dtype=np.float64) / population * per
+
+
+def carry_forward(data):
+    """Returns `data` with each NaN replaced by the last non-NaN value before it in its column;
+    NaN before the first one
+    """
+    data = np.asarray(data, dtype=np.float64)
+    rows = np.arange(data.shape[0]).reshape((-1,) + (1,) * (data.ndim - 1))
+    last = np.maximum.accumulate(np.where(np.isnan(data), 0, rows), axis=0)
+    return np.take_along_axis(data, last, axis=0)
+
+
+def daily_rate(cumulative):
+    """Returns the change of a cumulative count per day since its previous non-NaN day, so that
+    a report after a gap is not mistaken for a jump; NaN on NaN days and before the first one
+    """
+    data = np.asarray(cumulative, dtype=np.float64)
+    rows = np.arange(data.shape[0]).reshape((-1,) + (1,) * (data.ndim - 1))
+    last = np.maximum.accumulate(np.where(np.isnan(data), -1, rows), axis=0)
+    previous = np.concatenate([np.full_like(last[:1], -1), last[:-1]])
+    before = np.take_along_axis(data, np.maximum(previous, 0), axis=0)
+    with np.errstate(invalid='ignore'):
+        rate = (data - before) / (rows - previous)
+    rate[previous < 0] = np.nan
+    return rate
+
+
+def backward_steps(cumulative):
+    """Returns (mask, corrected): the days on which a cumulative count is below the highest
+    count reported before it, i.e. went backwards, and the counts with each such day raised to
+    that highest count. NaN days are neither flagged nor filled.
+    """
+    cumulative = np.asarray(cumulative, dtype=np.float64)
+    highest = np.fmax.accumulate(cumulative, axis=0)
+    with np.errstate(invalid='ignore'):
+        mask = cumulative < highest
+    return mask, np.where(mask, highest, cumulative)
+
+
+def missing_days(data):
+    """Returns a mask of the NaN days between the first and last non-NaN day of each column"""
+    reported = ~np.isnan(np.asarray(data, dtype=np.float64))
+    since_first = np.logical_or.accumulate(reported, axis=0)
+    until_last = np.logical_or.accumulate(reported[::-1], axis=0)[::-1]
+    return since_first & until_last & ~reported
+
+
+def trailing_zscore(data, window=28, min_periods=7, min_std=1):
+    """Returns (z-scores, means): the z-score of each day against the mean and standard deviation
+    of the `window` days before it, ignoring NaN days, and that mean; NaN with fewer than
+    `min_periods` such days. The standard deviation is at least `min_std`, so that a flat
+    stretch does not make every change an outlier. O(n) via prefix sums, like `rolling_sum`.
+    """
+    data = np.asarray(data, dtype=np.float64)
+    reported = ~np.isnan(data)
+    values = np.where(reported, data, 0)
+    end = np.arange(data.shape[0])
+    start = np.clip(end - window, 0, None)
+    counts = _window_sums(reported.astype(np.float64), start, end)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = _window_sums(values, start, end) / counts
+        std = np.sqrt(np.maximum(_window_sums(values ** 2, start, end) / counts - mean ** 2, 0))
+        z = (data - mean) / np.maximum(std, min_std)
+    z[counts < min_periods] = np.nan
+    return z, mean
+
+
+def lttb(x, y, n):
+    """Returns the indices of `n` points of the series (x, y) picked by Largest-Triangle-Three-
+    Buckets, which keeps the visual shape of a line with far fewer points. The first and last
+    points are always kept; series of at most `n` points are returned whole.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    size = len(y)
+    if n >= size or n < 3:
+        return np.arange(size)
+    # n - 2 buckets over the interior points, plus the first and last points
+    edges = np.linspace(1, size - 1, n - 1).astype(np.int64)
+    index = np.empty(n, dtype=np.int64)
+    index[0], index[-1] = 0, size - 1
+    # mean of each bucket, and of the last point, which follows the last bucket
+    counts = np.append(np.diff(edges), 1)
+    avg_x = np.add.reduceat(x, np.append(edges[:-1], size - 1)) / counts
+    avg_y = np.add.reduceat(y, np.append(edges[:-1], size - 1)) / counts
+    a = 0
+    for i in range(n - 2):
+        start, end = edges[i], edges[i + 1]
+        xs, ys = x[start:end], y[start:end]
+        # twice the area of the triangle (previous pick, candidate, next bucket average)
+        area = np.abs((x[a] - avg_x[i + 1]) * (ys - y[a]) - (x[a] - xs) * (avg_y[i + 1] - y[a]))
+        # NaN counts lose to any real point
+        a = start + int(np.argmax(np.where(area == area, area, -1)))
+        index[i + 1] = a
+    return index
@@ -1,36 +1,335 @@
 import dash
+import flask
 from dash import dcc
 from dash import html
+import os
 import json
+import time
+import logging
+import threading
+import pymongo
 import numpy as np
 import pandas as pd
 import plotly.graph_objects as go
-from dash.dependencies import Input, Output
-from utils import get_state_codes, get_state_name, daily_increase, moving_average
-from utils import all_states, state_code_dict, state_map_dict, fip_to_county, fip_to_state
+from dash.dependencies import Input, Output, State
+import utils
+from utils import geo_registry, daily_increase, moving_average
+from utils import all_states, fip_to_county, fip_to_state
+from utils import fips_to_state, fips_to_county, fips_to_str, fetch_cached
 from functools import reduce
 from datetime import datetime
-from urllib.request import urlopen
 import plotly.graph_objects as go
 import plotly.express as px
 from plotly.subplots import make_subplots
 
-from database import fetch_all_data_as_df
+from database import fetch_all_data_as_df, ensure_schema, watch_data_version
+from database import VERSION_POLL_INTERVAL, get_data_version as published_data_version
+from analytics import lttb, to_matrix
+import figure_cache
+import snapshot
+import metrics
 
 # Definitions of constants. This projects uses extra CSS stylesheet at `./assets/style.css`
 external_stylesheets = ['https://codepen.io/chriddyp/pen/bWLwgP.css', '/assets/style.css']
+LABELS = ['cases', 'deaths']
 colors = {
 "cases": 'rgb(49,130,189)',
 "deaths": 'rgb(16, 112, 2)'
 }
+COUNTIES_GEOJSON_URL = 'https://raw.githubusercontent.com/plotly/datasets/master/geojson-counties-fips.json'
+GRAPH_WIDTH = 1100              # pixels of the time-series graphs, which sets their downsampling
+POINTS_PER_PIXEL = 0.5          # points sent per pixel of graph width after downsampling
+DEFAULT_STATES = ['New York', 'California', 'Texas', 'Florida']
+DAILY_COLUMN = 'new_{}_7d'      # derived column plotted as daily new counts (see `update_derived`)
+GEOJSON_TIMEOUT = 10            # seconds to download the county boundaries
+GEOJSON_RETRY = 300             # seconds before downloading them again after a failure
+SNAPSHOT_WAIT = 2.0             # seconds to wait for the snapshot of a new version before reading Mongo
+COMPRESS_MIN_BYTES = 1024       # smaller responses are sent uncompressed
+COMPRESS_LEVEL = 5              # gzip level; higher levels barely shrink figure JSON further
+# set by `gunicorn.conf.py`: the master process then loads the data before forking the workers,
+# which each start their own refresh thread (see `after_fork`)
+PRELOAD = os.environ.get('COVID_TRACKER_PRELOAD') == '1'
+
+# Define the dash app first; `compress` gzips responses through flask-compress
+app = dash.Dash(__name__, external_stylesheets=external_stylesheets, compress=True)
+app.server.config.update(COMPRESS_LEVEL=COMPRESS_LEVEL, COMPRESS_MIN_SIZE=COMPRESS_MIN_BYTES)
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'app.log')
+# filled in by `load_data` once the acquirer has published data; until then graphs show a
+# loading state instead of blocking startup
+df_dict = {}
+data_version = None
+
+
+@app.server.before_request
+def start_request():
+    flask.g.start = time.perf_counter()
+    if metrics.profiler is not None:
+        metrics.profiler.begin()
+
+
+@app.server.after_request
+def record_request(response):
+    """Records the latency, status and size of every response by route, and by output for
+    callback requests, so that slow graphs can be told apart. Runs before flask-compress, so the
+    size is that of the uncompressed response.
+    """
+    elapsed = time.perf_counter() - flask.g.start
+    labels = {'route': flask.request.url_rule.rule if flask.request.url_rule else 'unmatched'}
+    if labels['route'] == '/_dash-update-component':
+        labels['output'] = (flask.request.get_json(silent=True) or {}).get('output', '')
+    metrics.observe('covid_http_request_seconds', elapsed, **labels)
+    metrics.inc('covid_http_requests_total', status=response.status_code, **labels)
+    if not response.direct_passthrough:
+        metrics.observe('covid_http_response_bytes', len(response.get_data()),
+                        buckets=metrics.BYTES_BUCKETS, **labels)
+    if metrics.profiler is not None:
+        metrics.profiler.end(labels.get('output') or labels['route'], elapsed)
+    return response
+
+
+@app.server.teardown_request
+def end_request(error):
+    # requests that failed before `record_request` are not profiled
+    if metrics.profiler is not None:
+        metrics.profiler.end('', 0)
+
+
+@app.server.route('/metrics')
+def serve_metrics():
+    """Serves this worker's metrics in the Prometheus text format"""
+    return flask.Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+
+_counties_geojson = None
+_counties_geojson_failed = None         # time of the last failed download
+
+
+def counties_geojson():
+    """Returns the county boundaries for the county heat map, downloaded on first use only
+    (see `fetch_cached`), or None if they cannot be had; a failed download is retried after
+    `GEOJSON_RETRY` seconds
+    """
+    global _counties_geojson, _counties_geojson_failed
+    if _counties_geojson is None and (_counties_geojson_failed is None or
+                                      time.monotonic() - _counties_geojson_failed >= GEOJSON_RETRY):
+        try:
+            _counties_geojson = json.loads(fetch_cached(COUNTIES_GEOJSON_URL,
+                                                        'geojson-counties-fips.json',
+                                                        GEOJSON_TIMEOUT))
+        except (OSError, ValueError) as e:
+            logger.warning('county boundaries unavailable: {}'.format(e))
+            _counties_geojson_failed = time.monotonic()
+    return _counties_geojson
+
+def state_order(names):
+    """Returns the column order of the state matrices: `all_states` first, then any other
+    jurisdiction in `names` alphabetically
+    """
+    known = set(all_states)
+    return list(all_states) + sorted(set(names) - known)
+
+
+def state_matrices(df, daily=None):
+    """Pivots the long-format states frame into dense date x state arrays, one column per
+    jurisdiction in `state_order`, stored column-major so each state's series is a contiguous
+    view. Returns a dict of the dates, the state names, their column numbers, and an array per
+    label (cumulative) and per `<label>_daily`, the 7-day average of the daily increase that
+    the acquirer keeps in the derived `daily` frame (NaN where it has none).
+    """
+    order = state_order(df['state'].unique())
+    matrices = {'states': order, 'column': {name: i for i, name in enumerate(order)}}
+    for label in ['cases', 'deaths']:
+        dates, _, cumulative = to_matrix(df, label, fill=True, order=order)
+        matrices[label] = np.asfortranarray(cumulative)
+        column = DAILY_COLUMN.format(label)
+        if daily is not None and column in daily.columns:
+            values = to_matrix(daily, column, order=order, rows=dates)[2]
+        else:
+            values = np.full_like(cumulative, np.nan)
+        matrices[label + '_daily'] = np.asfortranarray(values)
+    matrices['dates'] = dates
+    # daily data without gaps is sent as a start date and step instead of a date per point
+    step = np.diff(dates)
+    matrices['regular'] = bool(len(dates) > 1 and (step == np.timedelta64(1, 'D')).all())
+    return matrices
+
+
+def state_flags(flags, matrices):
+    """Returns {(state, label): (rows, texts)}: the rows of the state matrices that the acquirer
+    flagged (see `data_acquire.quality_flags`) with a hover text describing each flag. Flags of
+    days missing from every state have no row and are left out.
+    """
+    if flags is None or len(flags) == 0:
+        return {}
+    dates = matrices['dates']
+    flagged = flags['date'].to_numpy().astype(dates.dtype)
+    rows = np.minimum(dates.searchsorted(flagged), len(dates) - 1)
+    flags = flags.assign(row=rows)[dates[rows] == flagged]
+    texts = {'backward': 'went back to {value:,.0f} from {corrected:,.0f}',
+             'missing': 'not reported, {corrected:,.0f} carried forward',
+             'spike': 'jumped {value:,.0f} a day, {score:.0f} SD above {corrected:,.0f}'}
+    ret = {}
+    for (state, label), group in flags.groupby(['state', 'label'], observed=True):
+        ret[(state, label)] = (group['row'].to_numpy(),
+                               [texts[flag['check']].format(**flag)
+                                for flag in group.to_dict('records')])
+    return ret
+
+
+def compact(values):
+    """Returns float `values` as float32 when that is exact, which halves their typed-array
+    encoding in figure JSON
+    """
+    finite = values[np.isfinite(values)]
+    if len(finite) == 0 or np.abs(finite).max() < 2**24:
+        return values.astype(np.float32)
+    return values
+
+
+def prepare_views(df_dict):
+    """Adds the read-only views the callbacks plot to `df_dict`, computed once per data load:
+    `states_matrix`, the state time series (see `state_matrices`), `states_month`, month x state
+    arrays of the values at each month start and the latest date (NaN before a state reports)
+    with the month labels and state codes, `states_flags`, the quality flags to overlay on the
+    state time series (see `state_flags`), and `counties_latest`, the counties on the latest
+    date with GeoJSON ids, when there are any
+    """
+    df_dict['states_matrix'] = state_matrices(df_dict['states'], df_dict.get('states_daily'))
+    df_dict['states_flags'] = state_flags(df_dict.get('states_quality'),
+                                          df_dict['states_matrix'])
+    df = df_dict['states']
+    df = df[(df.date.dt.day == 1) | (df.date == df.date.max())]
+    order = df_dict['states_matrix']['states']
+    months, _, cases = to_matrix(df, 'cases', order=order)
+    df_dict['states_month'] = {
+        # the year keeps months of different years in different animation frames
+        'months': pd.DatetimeIndex(months).strftime('%B %Y').tolist(),
+        'states': list(order),
+        'codes': geo_registry.codes(order).tolist(),
+        'cases': compact(cases),
+        'deaths': compact(to_matrix(df, 'deaths', order=order)[2])}
+    df = df_dict.get('counties')
+    # counties are optional: the source may not be ingested yet, or have failed on its own
+    if df is None or len(df) == 0 or 'fips' not in df.columns:
+        return df_dict
+    df = df[df.date == df.date.max()]
+    # resolve names and GeoJSON ids for the whole column at once through the FIPS index
+    df_dict['counties_latest'] = pd.DataFrame({
+        'fips': fips_to_str(df['fips']),
+        'county': fips_to_county(df['fips']),
+        'state': fips_to_state(df['fips']),
+        'date': df['date'].to_numpy(),
+        'cases': df['cases'].to_numpy(),
+        'deaths': df['deaths'].to_numpy()})
+    return df_dict
+
+
+def read_data(version):
+    """Returns the raw data of `version` from its snapshot (see `snapshot.write_snapshot`),
+    waiting up to `SNAPSHOT_WAIT` seconds for the acquirer to write it, or from MongoDB if
+    there is none. The MongoDB result is kept in `database.result_cache` for `version`, so
+    loading that version again in this process (e.g. by the refresh thread after `preload`, or
+    in workers forked from a preloading master) does not query it again.
+    """
+    deadline = time.monotonic() + SNAPSHOT_WAIT
+    while True:
+        ret = snapshot.load_snapshot(version)
+        if ret is not None:
+            return ret
+        if time.monotonic() >= deadline:
+            return fetch_all_data_as_df(allow_cached=True, version=version)
+        time.sleep(0.1)
+
+
+@metrics.timed('load_data')
+def load_data(version):
+    """Reloads `df_dict` for a newly published data `version`; called by the watcher thread.
+    The new dict is fully prepared before it replaces the old one, and is never modified after.
+    `data_version` is replaced after `df_dict`, so a figure cached under the new version is
+    always drawn from the new data; requests in flight keep the dict they started with.
+    """
+    global df_dict, data_version
+    ret = read_data(version)
+    if ret is not None:
+        # a copy: `ret` may be the dict held by `database.result_cache`, which must not change
+        df_dict, data_version = prepare_views(dict(ret)), version
+        calls = {callback: [(label, version) for label in ['cases', 'deaths']]
+                 for callback in [heat_map, county_heat_map]}
+        # the time-series graphs also pass their (initially empty) relayout data
+        calls.update({callback: [(label, version, None) for label in ['cases', 'deaths']]
+                      for callback in [cd, cd_stack]})
+        figure_cache.warm(version, calls)
+
+
+def get_data_version():
+    return data_version
+
+
+def cacheable_view(label, relayout=None, **arguments):
+    """Tells whether a figure call may be stored in `figure_cache`: a known label and the whole
+    x axis; other arguments are sent by the browser and would each add an entry
+    """
+    return label in LABELS and relayout is None
+
+
+def visible_range(relayout):
+    """Returns the zoomed [start, end] dates in a graph's `relayoutData`, or None when the whole
+    x axis is shown
+    """
+    if not relayout:
+        return None
+    if 'xaxis.range[0]' in relayout and 'xaxis.range[1]' in relayout:
+        bounds = [relayout['xaxis.range[0]'], relayout['xaxis.range[1]']]
+    elif 'xaxis.range' in relayout:
+        bounds = relayout['xaxis.range']
+    else:
+        return None
+    return [pd.Timestamp(bound) for bound in bounds]
+
+
+def zoom_changed(relayout):
+    """Tells whether a graph's `relayoutData` changes the x range (zoom, pan or reset) rather
+    than e.g. the graph size
+    """
+    return visible_range(relayout) is not None or bool(relayout and
+                                                       relayout.get('xaxis.autorange'))
+
+
+def downsample(df, label, x_range=None, width=GRAPH_WIDTH):
+    """Returns the dates and `label` values of `df` to plot on a graph `width` pixels wide:
+    the rows within `x_range` (plus one row on either side, so lines reach the edges), reduced
+    by LTTB to `POINTS_PER_PIXEL` points per pixel. Zooming in thus brings back full resolution
+    for the visible window only.
+    """
+    x = df['date'].to_numpy(dtype='datetime64[ns]')
+    y = df[label].to_numpy(dtype=np.float64, na_value=np.nan)
+    if x_range is not None:
+        start = max(np.searchsorted(x, x_range[0].to_datetime64(), 'left') - 1, 0)
+        end = np.searchsorted(x, x_range[1].to_datetime64(), 'right') + 1
+        x, y = x[start:end], y[start:end]
+    if width is None:
+        return x, y
+    keep = lttb(x.view(np.int64), y, int(width * POINTS_PER_PIXEL))
+    return x[keep], y[keep]
 
-# Define the dash app first
-app = dash.Dash(__name__, external_stylesheets=external_stylesheets)
-df_dict = fetch_all_data_as_df()
 
 # Define component functions
 
 
+def loading_figure(text='Loading data...'):
+    """Returns an empty dark figure showing `text`, by default while no data has been loaded yet"""
+    fig = go.Figure()
+    fig.update_layout(template='plotly_dark',
+                      plot_bgcolor='#23272c',
+                      paper_bgcolor='#23272c',
+                      xaxis={'visible': False},
+                      yaxis={'visible': False},
+                      annotations=[{'text': text, 'showarrow': False,
+                                    'font': {'size': 20}}])
+    return fig
+
+
 def page_header():
     """
     Returns the page header as a dash `html.Div`
@@ -91,14 +390,26 @@ def enhancement_description():
     )
 
 # Defines the dependencies of interactive components
-@app.callback(Output('cd', 'figure'),
-             Input('target-label', 'value'))
-def cd(label):
-    df = df_dict['us']
-    x = df['date']
+@app.callback(Output('data-version', 'data'),
+              Input('data-version-interval', 'n_intervals'),
+              State('data-version', 'data'))
+@metrics.timed('update_data_version', family='covid_callback')
+def update_data_version(n, current):
+    """Publishes the loaded data version to the page; graphs redraw only when it changes"""
+    if data_version == current:
+        return dash.no_update
+    return data_version
+
+@figure_cache.memoize('cd', get_data_version, cacheable_view)
+@metrics.timed('cd', family='covid_callback')
+def cd(label, version=None, relayout=None):
+    if 'us' not in df_dict:
+        return loading_figure()
+    x_range = visible_range(relayout)
+    x, y = downsample(df_dict['us'], label, x_range, GRAPH_WIDTH)
     stack=False
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=x, y=df[label], mode='lines', name=label,
+    fig.add_trace(go.Scatter(x=x, y=y, mode='lines', name=label,
                                 line={'width': 3, 'color': colors[label]},
                                 stackgroup='stack' if stack else None))
     # fig.add_trace(go.Scatter(x=x, y=df['Load'], mode='lines', name='Load',
@@ -112,17 +423,23 @@ def cd(label):
                       plot_bgcolor='#23272c',
                       paper_bgcolor='#23272c',
                       yaxis_title='MW',
-                      xaxis_title='Date/Time')
+                      xaxis_title='Date/Time',
+                      # keep the user's zoom when the zoomed-in figure replaces this one
+                      uirevision=label)
+    if x_range is not None:
+        fig.update_xaxes(range=x_range)
     return fig
 
-@app.callback(Output('cd_stack', 'figure'),
-             Input('daily-label', 'value'))
-def cd_stack(label, window_size=7):
-    df = df_dict['us']
-    x = df['date']
+@figure_cache.memoize('cd_stack', get_data_version, cacheable_view)
+@metrics.timed('cd_stack', family='covid_callback')
+def cd_stack(label, version=None, relayout=None, window_size=7):
+    if 'us' not in df_dict:
+        return loading_figure()
+    x_range = visible_range(relayout)
+    x, y = downsample(df_dict['us'], label, x_range, GRAPH_WIDTH)
     stack=True
     fig = go.Figure()
-    fig.add_trace(go.Scatter(x=x, y=df[label], mode='lines', name=label,
+    fig.add_trace(go.Scatter(x=x, y=y, mode='lines', name=label,
                                 line={'width': 2, 'color': colors[label]},
                                 stackgroup='stack' if stack else None))
     # fig.add_trace(go.Scatter(x=x, y=df['Load'], mode='lines', name='Load',
@@ -136,45 +453,200 @@ def cd_stack(label, window_size=7):
                       plot_bgcolor='#23272c',
                       paper_bgcolor='#23272c',
                       yaxis_title='MW',
-                      xaxis_title='Date/Time')
+                      xaxis_title='Date/Time',
+                      # keep the user's zoom when the zoomed-in figure replaces this one
+                      uirevision=label)
+    if x_range is not None:
+        fig.update_xaxes(range=x_range)
     return fig
 
 
 
-@app.callback(Output('heat-map-by-state', 'figure'),
-              Input('label-radioitems', 'value'))
-def heat_map(label):
-    """Create the heap map of given label in US at the beginning of given month"""
-    df = df_dict['states']
-    df['month'] = df.date.dt.month_name()
-    df['state_code'] = df['state'].apply(lambda x: get_state_codes(x))
-    df_month = df[((df.date.dt.day == 1) | (df.date == max(df.date)))]
-    fig = px.choropleth(df_month,
-                    locations='state_code',
-                    locationmode="USA-states",
+@figure_cache.memoize('heat_map', get_data_version, cacheable_view)
+@metrics.timed('heat_map', family='covid_callback')
+def heat_map(label, version=None):
+    """Create the heap map of given label in US at the beginning of given month
+    Locations and names are sent once in the trace; each animation frame only carries that
+    month's values as typed arrays.
+    """
+    if 'states_month' not in df_dict:
+        return loading_figure()
+    month = df_dict['states_month']
+    other = 'deaths' if label == 'cases' else 'cases'
+    values, others = month[label], month[other]
+    hover = {label: '%{z:.0f}', other: '%{customdata:.0f}'}
+    fig = go.Figure(
+        data=[go.Choropleth(locations=month['codes'], locationmode='USA-states',
+                            hovertext=month['states'], z=values[-1], customdata=others[-1],
+                            coloraxis='coloraxis',
+                            hovertemplate='<b>%{hovertext}</b><br><br>cases=' + hover['cases'] +
+                            '<br>deaths=' + hover['deaths'] + '<extra></extra>')],
+        frames=[go.Frame(name=name, data=[go.Choropleth(z=values[i], customdata=others[i])])
+                for i, name in enumerate(month['months'])])
+    top = np.nanmax(values) if np.isfinite(values).any() else 1
+    fig.update_layout(title_text=f"Heat Map - Total {label.title()} in US States",
+                      geo={'scope': 'usa'},
+                      coloraxis={'cmin': 0, 'cmax': top,
+                                 'colorscale': px.colors.sequential.Sunsetdark if \
+                                     label == 'cases' else px.colors.sequential.Greys},
+                      margin={"r":0,"l":0,"b":0},
+                      transition_duration=500,
+                      sliders=[{'active': len(month['months']) - 1,
+                                'currentvalue': {'prefix': 'month='},
+                                'len': 0.9, 'x': 0.1, 'pad': {'b': 10, 't': 60},
+                                'steps': [{'args': [[name], {'frame': {'duration': 0,
+                                                                       'redraw': True},
+                                                             'mode': 'immediate',
+                                                             'fromcurrent': True,
+                                                             'transition': {'duration': 0}}],
+                                           'label': name, 'method': 'animate'}
+                                          for name in month['months']]}])
+    fig.update_coloraxes(colorbar_title=f"<b>Color</b><br>Confirmed {label.title()}")
+    return fig
+
+
+# The time series and state heat map switch between cases and deaths in the browser: the server
+# sends both variants of each figure once per data version (and zoom), and a clientside callback
+# shows the selected one, so a toggle costs no request.
+SELECT_VARIANT = """
+function(label, figures) {
+    return figures ? figures[label] : window.dash_clientside.no_update;
+}
+"""
+for graph, radio in [('cd', 'target-label'), ('cd_stack', 'daily-label'),
+                     ('heat-map-by-state', 'label-radioitems')]:
+    app.clientside_callback(SELECT_VARIANT, Output(graph, 'figure'), Input(radio, 'value'),
+                            Input(graph + '-figures', 'data'))
+
+
+@app.callback(Output('cd-figures', 'data'),
+              Input('data-version', 'data'),
+              Input('cd', 'relayoutData'))
+@metrics.timed('cd_figures', family='covid_callback')
+def cd_figures(version, relayout):
+    if dash.ctx.triggered_id == 'cd' and not zoom_changed(relayout):
+        return dash.no_update
+    if visible_range(relayout):
+        # zoomed views are drawn per request; caching them would store every range ever viewed
+        return {label: cd.__wrapped__(label, version, relayout)
+                for label in ['cases', 'deaths']}
+    return {label: cd(label, version, None) for label in ['cases', 'deaths']}
+
+
+@app.callback(Output('cd_stack-figures', 'data'),
+              Input('data-version', 'data'),
+              Input('cd_stack', 'relayoutData'))
+@metrics.timed('cd_stack_figures', family='covid_callback')
+def cd_stack_figures(version, relayout):
+    if dash.ctx.triggered_id == 'cd_stack' and not zoom_changed(relayout):
+        return dash.no_update
+    if visible_range(relayout):
+        # zoomed views are drawn per request; caching them would store every range ever viewed
+        return {label: cd_stack.__wrapped__(label, version, relayout)
+                for label in ['cases', 'deaths']}
+    return {label: cd_stack(label, version, None) for label in ['cases', 'deaths']}
+
+
+@app.callback(Output('heat-map-by-state-figures', 'data'),
+              Input('data-version', 'data'))
+@metrics.timed('heat_map_figures', family='covid_callback')
+def heat_map_figures(version):
+    return {label: heat_map(label, version) for label in ['cases', 'deaths']}
+
+
+@app.callback(Output('heat-map-by-county', 'figure'),
+              Input('county-label-radioitems', 'value'),
+              Input('data-version', 'data'))
+@metrics.timed('county_heat_map', family='covid_callback')
+@figure_cache.memoize('county_heat_map', get_data_version,
+                      lambda **arguments: cacheable_view(**arguments) and
+                      counties_geojson() is not None)
+def county_heat_map(label, version=None):
+    """Create the heat map of given label in US counties on the latest date. Without county
+    boundaries, shows a placeholder that is not cached, so that the map appears once they are.
+    """
+    if 'counties_latest' not in df_dict:
+        return loading_figure()
+    geojson = counties_geojson()
+    if geojson is None:
+        return loading_figure('County boundaries unavailable')
+    df_latest = df_dict['counties_latest']
+    fig = px.choropleth(df_latest,
+                    geojson=geojson,
+                    locations='fips',
                     scope="usa",
-                    color=label, # a column in the dataset
-                    hover_name='state', # column to add to hover information
-                    hover_data = {'cases': ':.0f', 'deaths': ':.0f', 'state_code': False, 'month': False},
+                    color=label,
+                    range_color=(0, df_latest[label].quantile(0.95)),
+                    hover_name='county',
+                    hover_data={'state': True, label: ':.0f', 'fips': False, 'date': False},
                     color_continuous_scale=px.colors.sequential.Sunsetdark if \
                         label == 'cases' else px.colors.sequential.Greys,
-                    animation_group='state',
-                    animation_frame='month'
                    )
-    fig.update_layout(title_text=f"Heat Map - Total {label.title()} in US States"),
+    latest = df_latest['date'].max().strftime('%Y-%m-%d') if len(df_latest) else ''
+    fig.update_layout(title_text=f"Heat Map - Total {label.title()} in US Counties ({latest})")
     fig.update_layout(margin={"r":0,"l":0,"b":0})
-    fig.update_layout(transition_duration=500)
-
-    last_frame_num = len(fig.frames) -1
+    fig.update_traces(marker_line_width=0)
+    fig.update_coloraxes(colorbar_title=f"<b>Color</b><br>Confirmed {label.title()}")
+    return fig
 
-    fig.layout['sliders'][0]['active'] = last_frame_num
 
-    fig = go.Figure(data=fig['frames'][-1]['data'], frames=fig['frames'], layout=fig.layout)
-    fig.update_coloraxes(colorbar_title=f"<b>Color</b><br>Confirmed {label.title()}")
-    fig.layout.pop('updatemenus')
+@app.callback(Output('state-trends', 'figure'),
+              Input('state-dropdown', 'value'),
+              Input('state-label', 'value'),
+              Input('state-mode', 'value'),
+              Input('data-version', 'data'))
+@metrics.timed('state_trends', family='covid_callback')
+def state_trends(states, label, mode, version=None):
+    """Plots one line per selected state, each a column view of the pre-pivoted matrices, with
+    a marker on each day the acquirer flagged as a data issue. Not kept in `figure_cache`: the
+    slices are cheap, and every selection the browser sends would be an entry of its own.
+    """
+    if 'states_matrix' not in df_dict:
+        return loading_figure()
+    matrices = df_dict['states_matrix']
+    flags = df_dict['states_flags']
+    values = matrices[label if mode == 'cumulative' else label + '_daily']
+    dates = matrices['dates']
+    if matrices['regular'] and len(dates):
+        x = {'x0': pd.Timestamp(dates[0]), 'dx': 24 * 3600 * 1000}
+    else:
+        x = {'x': dates}
+    fig = go.Figure()
+    for state in states or []:
+        if state in matrices['column']:
+            column = matrices['column'][state]
+            fig.add_trace(go.Scatter(y=values[:, column], mode='lines', name=state,
+                                     line={'width': 2}, legendgroup=state, **x))
+            if (state, label) in flags:
+                rows, texts = flags[(state, label)]
+                fig.add_trace(go.Scatter(x=dates[rows], y=values[rows, column], mode='markers',
+                                         name=state + ' data issues', legendgroup=state,
+                                         showlegend=False, hovertext=texts,
+                                         hoverinfo='x+text+name',
+                                         marker={'symbol': 'x', 'size': 9, 'color': 'orange'}))
+    title = '{} {} by state'.format('Accumulated' if mode == 'cumulative' else 'Daily new',
+                                    label)
+    fig.update_layout(template='plotly_dark',
+                      title=title,
+                      plot_bgcolor='#23272c',
+                      paper_bgcolor='#23272c',
+                      xaxis_title='Date',
+                      yaxis_title=label.title() if mode == 'cumulative' else
+                      '{} (7-day average)'.format(label.title()),
+                      xaxis_type='date',
+                      uirevision=label)
     return fig
 
 
+@app.callback(Output('state-dropdown', 'options'),
+              Input('data-version', 'data'))
+@metrics.timed('state_options', family='covid_callback')
+def state_options(version):
+    """Lists the jurisdictions present in the loaded data, in `state_order`"""
+    names = df_dict['states_matrix']['states'] if 'states_matrix' in df_dict else all_states
+    return [{'label': name, 'value': name} for name in names]
+
+
 def architecture_summary():
     """
     Returns the text and image of architecture summary of the project.
@@ -234,7 +706,8 @@ def visualization_summary():
                         'font-weight': 'bold',
                         'color': 'white',
                         }),],  style={'width': '98%', 'display': 'inline-block'}),
-                dcc.Graph(id='cd', style={'height': 500, 'width': 1100})
+                dcc.Graph(id='cd', style={'height': 500, 'width': GRAPH_WIDTH}),
+                dcc.Store(id='cd-figures')
                 ],
                 style={'width': '98%', 'float': 'right', 'display': 'inline-block'}),
 
@@ -262,11 +735,56 @@ def visualization_summary():
                         'font-weight': 'bold',
                         'color': 'white',
                         }),],  style={'width': '98%', 'display': 'inline-block'}),
-                dcc.Graph(id='cd_stack', style={'height': 500, 'width': 1100})
+                dcc.Graph(id='cd_stack', style={'height': 500, 'width': GRAPH_WIDTH}),
+                dcc.Store(id='cd_stack-figures')
             ],
                 style={'width': '98%', 'float': 'right', 'display': 'inline-block'}),
 
 
+            # Time series curves of selected states
+            dcc.Markdown('''
+            #### Cases and deaths by state
+            Select states to compare their accumulated counts or 7-day average of new counts.
+            ''', className='row eleven columns', style={'paddingLeft': '5%'}),
+            html.Div([
+                html.Div([
+                    dcc.Dropdown(
+                        id='state-dropdown',
+                        options=[{'label': i, 'value': i} for i in all_states],
+                        value=DEFAULT_STATES,
+                        multi=True,
+                        style={'color': 'black'}),
+                    dcc.RadioItems(
+                        id='state-label',
+                        options=[{'label': i.title(), 'value': i} for i in ['cases', 'deaths']],
+                        value='cases',
+                        labelStyle={
+                        'display': 'inline-block',
+                        },
+                        style={
+                        'width': '20%',
+                        'float': 'left',
+                        'font-weight': 'bold',
+                        'color': 'white',
+                        }),
+                    dcc.RadioItems(
+                        id='state-mode',
+                        options=[{'label': 'Accumulated', 'value': 'cumulative'},
+                                 {'label': 'Daily (7-day average)', 'value': 'daily'}],
+                        value='cumulative',
+                        labelStyle={
+                        'display': 'inline-block',
+                        },
+                        style={
+                        'width': '40%',
+                        'float': 'left',
+                        'font-weight': 'bold',
+                        'color': 'white',
+                        }),],  style={'width': '98%', 'display': 'inline-block'}),
+                dcc.Graph(id='state-trends', style={'height': 500, 'width': GRAPH_WIDTH})
+            ],
+                style={'width': '98%', 'float': 'right', 'display': 'inline-block'}),
+
             # Heat map by month
             dcc.Markdown('''
             #### Heat Map - Covid in US states
@@ -294,13 +812,47 @@ def visualization_summary():
                         'font-weight': 'bold',
                         'color': 'white',
                         }),],  style={'width': '98%', 'display': 'inline-block'}),
-                dcc.Graph(id='heat-map-by-state', style={'height': 800, 'width': 1000})
+                dcc.Graph(id='heat-map-by-state', style={'height': 800, 'width': 1000}),
+                dcc.Store(id='heat-map-by-state-figures')
+            ],
+                style={'width': '100%', 'float':'right', 'display': 'inline-block'}),
+
+            # Heat map by county on the latest date
+            dcc.Markdown('''
+            #### Heat Map - Covid in US counties
+            The county-level COVID-19 data on the latest reported date, with county names resolved
+            from their FIPS codes.
+            ''', className='row eleven columns', style={'paddingLeft': '0%'}),
+
+            html.Div([
+                html.Div([
+                    html.Label( ['Label:'],
+                        style={'font-weight': 'bold', 'float': 'left',
+                               'color': 'white', 'display': 'inline-block',
+                               },
+                        ),
+                    dcc.RadioItems(
+                        id='county-label-radioitems',
+                        options=[{'label': i.title(), 'value': i} for i in ['cases', 'deaths']],
+                        value='cases',
+                        labelStyle={
+                        'display': 'inline-block',
+                        },
+                        style={
+                        'width': '20%',
+                        'float': 'left',
+                        'font-weight': 'bold',
+                        'color': 'white',
+                        }),],  style={'width': '98%', 'display': 'inline-block'}),
+                dcc.Graph(id='heat-map-by-county', style={'height': 800, 'width': 1000})
             ],
                 style={'width': '100%', 'float':'right', 'display': 'inline-block'}),
 
     ])
 
 app.layout = html.Div([
+        dcc.Store(id='data-version'),
+        dcc.Interval(id='data-version-interval', interval=VERSION_POLL_INTERVAL * 1000),
         page_header(),
         html.Hr(),
         project_description(),
@@ -310,5 +862,51 @@ app.layout = html.Div([
         architecture_summary(),
     ], className='row', id='content')
 
+
+def prepare_schema():
+    """Creates the indexes and validators of the collections (see `ensure_schema`). Failures
+    are only logged: the app serves the snapshot without MongoDB.
+    """
+    try:
+        ensure_schema()
+    except pymongo.errors.PyMongoError as e:
+        logger.warning('schema not ensured, is MongoDB reachable? {}'.format(e))
+
+
+def preload():
+    """Loads the published data version, if any, in the calling thread, or the current snapshot
+    when MongoDB is unreachable
+    """
+    prepare_schema()
+    try:
+        version = published_data_version()
+    except pymongo.errors.PyMongoError as e:
+        logger.warning('data version not read, loading the current snapshot: {}'.format(e))
+        version = snapshot.current_version()
+    if version is not None:
+        load_data(version)
+
+
+def start_refresh():
+    """Starts the thread that loads every newly published data version in the background"""
+    return watch_data_version(load_data, current=data_version)
+
+
+def after_fork():
+    """Called in each worker forked from a preloading master; threads do not survive fork, and
+    PyMongo resets its connections in the child by itself
+    """
+    start_refresh()
+
+
+# start watching for data only once every callback that `load_data` warms up is defined
+if PRELOAD:
+    preload()
+else:
+    # off the import path, which would otherwise wait for an unreachable MongoDB
+    threading.Thread(target=prepare_schema, name='prepare-schema', daemon=True).start()
+    start_refresh()
+
 if __name__ == '__main__':
-    app.run_server(debug=True, host='0.0.0.0')
\ No newline at end of file
+    # the debugger runs arbitrary code, so it only listens on localhost
+    app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,1578 @@
+"""
+Benchmarks for the ingest and serving paths
+Runs against the mongod of `--mongo-uri`, or an in-memory mongomock stand-in with `--mongomock`.
+Benchmarks drop and rewrite the collections they use, so a mongod is only used when it is empty
+or was last written by the benchmarks (see `_claim_scratch`).
+Results are printed as JSON. `--output` also writes them to a file with the commit and arguments
+of the run, and `--compare` reports the timings that got slower than in such a file.
+"""
+import argparse
+import collections
+import contextlib
+import gzip
+import json
+import logging
+import os
+import queue
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tracemalloc
+import multiprocessing
+import time
+import tempfile
+import threading
+import functools
+import inspect
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+import bson
+import numpy as np
+import pandas as pd
+import utils
+import analytics
+import data_acquire
+import database
+import metrics
+import snapshot
+
+WORKER_TIMEOUT = 900              # seconds a benchmark process may take to report its results
+MONGOMOCK = 'mongomock'           # stands for the in-memory client where a MongoDB URI is expected
+SCRATCH_MARKER = 'benchmark'      # collection of `database.META_DB` marking a benchmark's mongod
+
+def synthetic_states(years=3, n_states=56, start='2020-01-21', seed=0):
+    """Returns a NYT-shaped `us-states` DataFrame (date, state, fips, cases, deaths) covering
+    `years` years of daily cumulative counts for `n_states` jurisdictions
+    """
+    rng = np.random.default_rng(seed)
+    names = list(utils.all_states)
+    names += ['Jurisdiction {}'.format(i) for i in range(len(names), n_states)]
+    names = names[:n_states]
+    dates = pd.date_range(start, periods=int(years * 365), freq='D')
+    daily_cases = rng.poisson(200, size=(len(dates), n_states))
+    daily_deaths = rng.poisson(3, size=(len(dates), n_states))
+    return pd.DataFrame({
+        'date': np.repeat(dates, n_states),
+        'state': np.tile(names, len(dates)),
+        'fips': np.tile(np.arange(1, n_states + 1), len(dates)),
+        'cases': daily_cases.cumsum(axis=0).ravel(),
+        'deaths': daily_deaths.cumsum(axis=0).ravel(),
+    })
+
+
+def synthetic_counties(years=2, n_counties=3000, start='2020-01-21', seed=0):
+    """Returns a NYT-shaped `us-counties` DataFrame (date, county, state, fips, cases, deaths);
+    the defaults give about 2.2M rows, the size of the real feed
+    """
+    rng = np.random.default_rng(seed)
+    dates = pd.date_range(start, periods=int(years * 365), freq='D')
+    states = np.asarray(utils.all_states)[np.arange(n_counties) % len(utils.all_states)]
+    counties = np.array(['County {}'.format(i) for i in range(n_counties)], dtype=object)
+    fips = 1000 * (np.arange(n_counties) % len(utils.all_states) + 1) + np.arange(n_counties) // 55
+    daily_cases = rng.poisson(20, size=(len(dates), n_counties)).astype(np.int32)
+    daily_deaths = rng.poisson(0.3, size=(len(dates), n_counties)).astype(np.int32)
+    return pd.DataFrame({
+        'date': np.repeat(dates, n_counties),
+        'county': np.tile(counties, len(dates)),
+        'state': np.tile(states, len(dates)),
+        'fips': np.tile(fips, len(dates)),
+        'cases': daily_cases.cumsum(axis=0).ravel(),
+        'deaths': daily_deaths.cumsum(axis=0).ravel(),
+    })
+
+
+def synthetic_us(states):
+    """Returns the NYT-shaped `us` DataFrame (date, cases, deaths): the national totals of a
+    `synthetic_states` frame
+    """
+    return states.groupby('date', as_index=False)[['cases', 'deaths']].sum()
+
+
+def synthetic_data(years=3, n_counties=3000, seed=0):
+    """Returns NYT-shaped us, states and counties DataFrames covering `years` years, keyed by
+    the collection they are ingested into
+    """
+    states = synthetic_states(years=years, seed=seed)
+    return {'us': synthetic_us(states), 'states': states,
+            'counties': synthetic_counties(years=years, n_counties=n_counties, seed=seed)}
+
+
+def bench_upsert(args):
+    """Ingests a synthetic states history into an empty collection, then re-ingests it unchanged
+    and with the latest day revised, comparing the bulk and row-by-row `upsert_data` modes
+    """
+    df = synthetic_states(years=args.years)
+    collection = data_acquire.client.get_database('states').get_collection('states')
+    revised = df.copy()
+    revised.loc[revised['date'] == revised['date'].max(), 'cases'] += 1
+    results = {}
+    for mode, bulk in [('bulk', True), ('row_by_row', False)]:
+        collection.drop()
+        results[mode] = {
+            'initial': data_acquire.upsert_data(df, 'states', bulk=bulk),
+            'no_change': data_acquire.upsert_data(df, 'states', bulk=bulk),
+            'revision': data_acquire.upsert_data(revised, 'states', bulk=bulk),
+        }
+        no_change, revision = results[mode]['no_change'], results[mode]['revision']
+        assert no_change['inserted'] == revision['inserted'] == 0, results[mode]
+        if bulk:
+            # a record_hash that misses changes, or sees them everywhere, must not pass silently
+            assert no_change['updated'] == 0, no_change
+            assert no_change['unchanged'] == no_change['rows'] == len(df), no_change
+            assert revision['updated'] == (df['date'] == df['date'].max()).sum(), revision
+        else:
+            # row by row, every row is written
+            assert no_change['updated'] == revision['updated'] == len(df), results[mode]
+    collection.drop()
+    return results
+
+
+def _time_queries(collection, states, repeat=20):
+    """Returns mean seconds of the app's latest-date and per-state time-range queries"""
+    timings = {}
+    start = time.perf_counter()
+    for _ in range(repeat):
+        latest = next(collection.find({}, {'date': 1}).sort('date', -1).limit(1))['date']
+    timings['latest_date'] = (time.perf_counter() - start) / repeat
+    start = time.perf_counter()
+    for state in states[:repeat]:
+        list(collection.find({'state': state, 'date': {'$gte': latest - pd.Timedelta(days=90)}}))
+    timings['state_range'] = (time.perf_counter() - start) / min(repeat, len(states))
+    return timings
+
+
+def bench_indexes(args):
+    """Compares upsert and query latency on the states collection with and without the indexes
+    created by `database.ensure_schema`
+    """
+    df = synthetic_states(years=args.years)
+    revised = df[df['date'] >= df['date'].max() - pd.Timedelta(days=14)].copy()
+    revised['cases'] += 1
+    states = list(df['state'].unique())
+    collection = data_acquire.client.get_database('states').get_collection('states')
+    results = {}
+    for mode in ['without_indexes', 'with_indexes']:
+        collection.drop()
+        if mode == 'with_indexes':
+            database.ensure_schema(data_acquire.client)
+        data_acquire.upsert_data(df, 'states')
+        results[mode] = {'revision_upsert': data_acquire.upsert_data(revised, 'states', bulk=False),
+                         'queries': _time_queries(collection, states)}
+    collection.drop()
+    return results
+
+
+class _QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def serve_directory(directory):
+    """Starts a local HTTP stand-in serving `directory` in a daemon thread; returns the server.
+    `SimpleHTTPRequestHandler` honours If-Modified-Since, so it exercises conditional downloads.
+    """
+    handler = functools.partial(_QuietHandler, directory=directory)
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+class _FlakyHandler(_QuietHandler):
+    """Serves files after `latency` seconds, answering 503 to the first `failures[name]` requests
+    of each file (every request when negative), and gzip-encoding bodies when the client accepts
+    it. Requests and bytes written are counted per file in `requests` and `sent`.
+    """
+    latency = 0
+    failures = {}
+    requests = collections.Counter()
+    sent = collections.Counter()
+
+    def do_GET(self):
+        time.sleep(self.latency)
+        name = self.path.lstrip('/')
+        self.requests[name] += 1
+        remaining = self.failures.get(name, 0)
+        if remaining:
+            self.failures[name] = remaining - 1
+            self.send_error(503)
+            return
+        path = os.path.join(self.directory, name)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as f:
+            body = f.read()
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body, compresslevel=1)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        self.sent[name] += len(body)
+
+
+def serve_flaky(directory, latency=0, failures=None):
+    """Starts a local HTTP stand-in like `serve_directory` that injects latency and errors
+    (see `_FlakyHandler`); returns the server, whose `requests` and `sent` count the requests
+    and bytes sent per file
+    """
+    handler = type('Handler', (_FlakyHandler,), {'latency': latency,
+                                                 'failures': dict(failures or {}),
+                                                 'requests': collections.Counter(),
+                                                 'sent': collections.Counter()})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), functools.partial(handler, directory=directory))
+    server.requests, server.sent = handler.requests, handler.sent
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _write_fixture(df, path, mtime):
+    df.to_csv(path, index=False, date_format='%Y-%m-%d')
+    os.utime(path, (mtime, mtime))
+
+
+def bench_delta(args):
+    """Runs `ingest_delta` against fixture CSVs served locally: the first cycle, a no-change
+    cycle (expected 304 and near-zero work) and a cycle after one new day is published. Also
+    checks the derived daily count of a jurisdiction whose new day is its first report since
+    the start.
+    """
+    df = synthetic_states(years=args.years)
+    latest = df['date'].max()
+    sparse = pd.DataFrame({'date': [df['date'].min(), latest], 'state': 'Sparse', 'fips': 99,
+                           'cases': [100, 105], 'deaths': [1, 1]})
+    # NYT files are sorted by date, which `tail_text` relies on
+    df = pd.concat([df, sparse]).sort_values('date', kind='stable').reset_index(drop=True)
+    collection = data_acquire.client.get_database('states').get_collection('states')
+    derived = data_acquire.client.get_database('states').get_collection(database.derived['states'])
+    collection.drop()
+    derived.drop()
+    data_acquire.client.get_database(database.META_DB).get_collection('ingest').delete_many({})
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        server = serve_directory(directory)
+        url = 'http://127.0.0.1:{}/us-states.csv'.format(server.server_port)
+        path = os.path.join(directory, 'us-states.csv')
+        mtime = time.time() - 3600
+        _write_fixture(df[df['date'] < latest], path, mtime)
+        for cycle, update in [('initial', False), ('no_change', False), ('new_day', True)]:
+            if update:
+                _write_fixture(df, path, mtime + 60)
+            start = time.perf_counter()
+            stats = data_acquire.ingest_delta('states', url)
+            results[cycle] = {'seconds': time.perf_counter() - start, 'rows': stats['rows'],
+                              'inserted': stats['inserted'], 'updated': stats['updated'],
+                              'not_modified': stats.get('not_modified', False)}
+        server.shutdown()
+    doc = derived.find_one({'state': 'Sparse', 'date': latest.to_pydatetime()})
+    results['sparse_new_cases'] = doc and doc['new_cases']
+    collection.drop()
+    derived.drop()
+    no_change, new_day = results['no_change'], results['new_day']
+    assert no_change['not_modified'], no_change
+    assert no_change['rows'] == no_change['inserted'] == no_change['updated'] == 0, no_change
+    assert not new_day['not_modified'], new_day
+    assert new_day['inserted'] == (df['date'] == latest).sum() and new_day['updated'] == 0, new_day
+    # the difference from its previous report, not its whole count
+    assert results['sparse_new_cases'] == 5, results['sparse_new_cases']
+    return results
+
+
+def _fetch_all(sources, workers):
+    """Runs the pipeline's download stage, `fetch_source`, for every source of `sources` on
+    `workers` threads, as `IngestPipeline` does; returns {name: text}, None for failed sources
+    """
+    def _fetch(geo):
+        req = data_acquire.fetch_source(geo, sources[geo])[1]
+        return None if req is None else req.text
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        return dict(zip(sources, pool.map(_fetch, sources)))
+
+
+def bench_download(args):
+    """Downloads NYT-shaped sources through the pipeline's download stage from a local stand-in
+    that adds latency, fails some requests with 503 (retried), one source with 404 and one with
+    503 on every request, sequentially and concurrently. Backoff is scaled down so the
+    always-failing source gives up quickly.
+    """
+    latency = 0.3
+    failures = {'flaky.csv': 2, 'down.csv': -1}
+    base, cap = data_acquire.BACKOFF_BASE, data_acquire.BACKOFF_CAP
+    data_acquire.BACKOFF_BASE, data_acquire.BACKOFF_CAP = 0.01, 0.1
+    results = {'latency_seconds': latency}
+    with tempfile.TemporaryDirectory() as directory:
+        states = synthetic_states(years=args.years)
+        files = {'us': synthetic_us(states),
+                 'states': states,
+                 'counties': synthetic_counties(years=min(args.years, 1), n_counties=1000),
+                 'flaky': states}
+        for name, df in files.items():
+            df.to_csv(os.path.join(directory, name + '.csv'), index=False, date_format='%Y-%m-%d')
+        workers = data_acquire.DOWNLOAD_WORKERS
+        for mode, n, extra in [('sequential', 1, []), ('concurrent', workers, []),
+                               ('concurrent_with_failures', workers, ['missing', 'down'])]:
+            server = serve_flaky(directory, latency, failures)
+            url = 'http://127.0.0.1:{}/'.format(server.server_port)
+            sources = {name: url + name + '.csv' for name in list(files) + extra}
+            # no saved validators, so every source is downloaded in full rather than a 304
+            data_acquire.client.get_database(database.META_DB).get_collection(
+                'ingest').delete_many({})
+            start = time.perf_counter()
+            texts = _fetch_all(sources, n)
+            results[mode] = {'seconds': time.perf_counter() - start,
+                             'succeeded': sorted(k for k, v in texts.items() if v is not None),
+                             'failed': sorted(k for k, v in texts.items() if v is None),
+                             'requests': dict(server.requests)}
+            server.shutdown()
+            server.server_close()
+            assert results[mode]['succeeded'] == sorted(files), results[mode]
+            assert results[mode]['failed'] == sorted(extra), results[mode]
+            # 503s are retried until the file is served or the attempts run out; 404 is not
+            expected = {'flaky.csv': failures['flaky.csv'] + 1,
+                        'down.csv': data_acquire.MAX_DOWNLOAD_ATTEMPT, 'missing.csv': 1}
+            for name, count in expected.items():
+                if name[:-len('.csv')] in sources:
+                    assert server.requests[name] == count, (name, results[mode])
+        file_bytes = sum(os.path.getsize(os.path.join(directory, name + '.csv')) for name in files)
+        results['bytes'] = {'files': file_bytes, 'sent_gzip': sum(server.sent.values())}
+        results['complete'] = all(
+            texts[name] is not None and
+            len(texts[name]) == os.path.getsize(os.path.join(directory, name + '.csv'))
+            for name in files)
+    data_acquire.BACKOFF_BASE, data_acquire.BACKOFF_CAP = base, cap
+    assert results['complete'], results
+    return results
+
+
+def bench_pipeline(args):
+    """Backfills NYT-shaped us/states/counties files from a local stand-in with added latency,
+    one source after another with `stream_ingest` and through the `IngestPipeline`, and reports
+    wall time and the pipeline's per-stage seconds
+    """
+    latency = 0.2
+    files = synthetic_data(years=args.years, n_counties=300)
+    results = {'rows': {geo: len(df) for geo, df in files.items()}}
+    with tempfile.TemporaryDirectory() as directory:
+        for geo, df in files.items():
+            df.to_csv(os.path.join(directory, geo + '.csv'), index=False, date_format='%Y-%m-%d')
+        server = serve_flaky(directory, latency)
+        url = 'http://127.0.0.1:{}/'.format(server.server_port)
+        sources = {geo: url + geo + '.csv' for geo in files}
+        for mode in ['sequential', 'pipelined']:
+            _clear()
+            data_acquire.client.get_database(database.META_DB).get_collection('ingest').drop()
+            database.ensure_schema(data_acquire.client)
+            start = time.perf_counter()
+            if mode == 'sequential':
+                for geo, source in sources.items():
+                    data_acquire.stream_ingest(geo, source)
+            else:
+                runs = data_acquire.backfill(sources)
+            results[mode] = {'seconds': time.perf_counter() - start}
+        results['pipelined']['stages'] = {geo: dict(run['timings']) for geo, run in runs.items()}
+        results['pipelined']['documents'] = {
+            geo: database.client.get_database(geo).get_collection(geo).count_documents({})
+            for geo in files}
+        pipeline = data_acquire.IngestPipeline(sources)
+        results['overlapping_submit_refused'] = pipeline.submit('us') and not pipeline.submit('us')
+        pipeline.wait()
+        server.shutdown()
+    _clear()
+    assert results['pipelined']['documents'] == results['rows'], results
+    assert results['overlapping_submit_refused'], results
+    return results
+
+
+def _parse_worker(url, chunksize, queue):
+    """Parses `url` in a fresh process and reports rows, seconds and peak RSS before (after
+    imports) and after parsing
+    """
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    rows = 0
+    if chunksize:
+        with contextlib.closing(data_acquire.download_data(url, stream=True)) as body:
+            for df in data_acquire.filter_data(body, chunksize=chunksize):
+                rows += df.shape[0]         # stand-in writer; parse cost only
+    else:
+        rows = data_acquire.filter_data(data_acquire.download_data(url)).shape[0]
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    queue.put({'rows': rows, 'seconds': elapsed, 'rows_per_sec': rows / elapsed,
+               'baseline_rss_mb': baseline / 1024, 'peak_rss_mb': peak / 1024})
+
+
+def bench_parse(args):
+    """Downloads and parses a counties-sized CSV from a local HTTP stand-in, in memory and as a
+    chunked stream, each in its own process so peak RSS is comparable
+    """
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        synthetic_counties(years=args.years).to_csv(os.path.join(directory, 'us-counties.csv'),
+                                                    index=False, date_format='%Y-%m-%d')
+        server = serve_directory(directory)
+        url = 'http://127.0.0.1:{}/us-counties.csv'.format(server.server_port)
+        for mode, chunksize in [('in_memory', None), ('streaming', data_acquire.PARSE_CHUNK_ROWS)]:
+            results[mode] = _run_worker(_parse_worker, url, chunksize)
+        results['file_mb'] = os.path.getsize(os.path.join(directory, 'us-counties.csv')) / 2**20
+        server.shutdown()
+    return results
+
+
+def _mask_fip_to_state(fip):
+    """The original per-call boolean-mask scan over `utils.fips_code`, kept as a baseline"""
+    values = utils.fips_code.loc[utils.fips_code.fips == fip, 'state'].to_numpy()
+    return 'N/A' if len(values) == 0 else values[0]
+
+
+def bench_fips(args):
+    """Resolves 1M FIPS codes to state names per row (mask scan, extrapolated from a sample, and
+    index-backed scalar lookup) and vectorized through `utils.fips_to_state`
+    """
+    rng = np.random.default_rng(0)
+    fips = rng.choice(utils.fips_code['fips'].to_numpy(), size=args.fips_rows)
+    sample = fips[:args.fips_rows // 1000]
+    start = time.perf_counter()
+    expected = [_mask_fip_to_state(f) for f in sample]
+    mask_seconds = (time.perf_counter() - start) * len(fips) / len(sample)
+    start = time.perf_counter()
+    scalar = [utils.fip_to_state(f) for f in sample]
+    scalar_seconds = (time.perf_counter() - start) * len(fips) / len(sample)
+    start = time.perf_counter()
+    vectorized = utils.fips_to_state(fips)
+    vectorized_seconds = time.perf_counter() - start
+    assert list(vectorized[:len(sample)]) == expected == scalar
+    return {'rows': len(fips),
+            'per_row_mask_seconds_extrapolated': mask_seconds,
+            'per_row_index_seconds_extrapolated': scalar_seconds,
+            'vectorized_seconds': vectorized_seconds,
+            'speedup_vs_mask': mask_seconds / vectorized_seconds}
+
+
+def _scan_state_name(code, table):
+    """The original `get_state_name`: a linear scan over the inverted name -> code dict"""
+    for name, value in table.items():
+        if value == code:
+            return name
+    return 'Others'
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
+def bench_geo(args):
+    """Times state name/code lookups per call (the original linear scan against the registry)
+    and over `--fips-rows` values (row-wise `apply` against the vectorized registry methods),
+    and checks the registry against the cases the original dicts got wrong
+    """
+    registry = utils.geo_registry
+    # the original inverted dict, where 'D.C.' overwrote 'DC' and 'Chicago' maps to a name
+    original = {v: k for k, v in utils.state_map_dict.items()}
+    original['Chicago'] = 'Illinois'
+    rng = np.random.default_rng(0)
+    names = list(registry.name_to_code) + ['Atlantis']
+    codes = list(registry.code_to_name) + ['ZZ']
+    name_column = pd.Series(rng.choice(names, size=args.fips_rows))
+    code_column = pd.Series(rng.choice(codes, size=args.fips_rows))
+    locations = pd.Series(rng.choice(['Seattle, WA', 'Washington, D.C.', 'Guam', 'Springfield, IL',
+                                      'Unknown'], size=args.fips_rows))
+    sample = code_column[:10000].tolist()
+    results = {'rows': args.fips_rows}
+    expected, results['scan_name_per_call_us'] = _timed(
+        lambda: [_scan_state_name(c, original) for c in sample])
+    actual, results['registry_name_per_call_us'] = _timed(
+        lambda: [utils.get_state_name(c) for c in sample])
+    for key in ['scan_name_per_call_us', 'registry_name_per_call_us']:
+        results[key] *= 1e6 / len(sample)
+    for label, column, scalar, vectorized in [
+            ('codes', name_column, utils.get_state_codes, registry.codes),
+            ('codes_categorical', name_column.astype('category'), utils.get_state_codes,
+             registry.codes),
+            ('names', code_column, utils.get_state_name, registry.names),
+            ('correct_names', locations, utils.correct_state_names, registry.correct_names)]:
+        rowwise, rowwise_seconds = _timed(lambda: column.apply(scalar).to_numpy())
+        fast, fast_seconds = _timed(vectorized, column)
+        results[label] = {'apply_seconds': rowwise_seconds, 'vectorized_seconds': fast_seconds,
+                          'same_result': bool((np.asarray(rowwise, dtype=object) ==
+                                               np.asarray(fast, dtype=object)).all())}
+    states = utils.reference()['states']
+    results['correct'] = {
+        'dc_name': registry.name('DC') == 'District of Columbia',
+        'dc_code': registry.code('District of Columbia') == 'DC',
+        'chicago_code': registry.code('Chicago') == 'IL',
+        'round_trip': all(registry.name(registry.code(n)) == n for n in states['state']),
+        'fips': all(registry.fips(c) == f and registry.code_of_fips(f) == c
+                    for c, f in zip(states['code'], states['fips'])),
+        'scan_agrees_except_dc': all(e == a for e, a, c in zip(expected, actual, sample)
+                                     if c != 'DC'),
+    }
+    failed = [label for label, result in results.items()
+              if isinstance(result, dict) and result.get('same_result') is False]
+    failed += ['correct.' + check for check, ok in results['correct'].items() if not ok]
+    assert not failed, failed
+    return results
+
+
+def _loop_daily_increase(data):
+    """The original pure-Python `utils.daily_increase`, kept as a baseline"""
+    d = []
+    for i in range(len(data)):
+        if i == 0:
+            d.append(data[0])
+        else:
+            d.append(data[i]-data[i-1])
+    return d
+
+
+def _loop_moving_average(data, window_size=7):
+    """The original pure-Python `utils.moving_average`, kept as a baseline"""
+    moving_average = []
+    for i in range(len(data)):
+        if i + window_size < len(data):
+            moving_average.append(np.mean(data[i:i+window_size]))
+        else:
+            moving_average.append(np.mean(data[i:len(data)]))
+    return moving_average
+
+
+def bench_analytics(args):
+    """Computes daily increases and 7-day moving averages for every state, per state with the
+    original loops and in one pass over the date x state matrix with `analytics`
+    """
+    dates, states, cases = analytics.to_matrix(synthetic_states(years=args.years), 'cases')
+    start = time.perf_counter()
+    loop_diff = np.column_stack([_loop_daily_increase(cases[:, j]) for j in range(len(states))])
+    loop_mean = np.column_stack([_loop_moving_average(cases[:, j]) for j in range(len(states))])
+    loop_seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    diff = analytics.daily_diff(cases)
+    mean = analytics.rolling_mean(cases, 7, align='forward')
+    vectorized_seconds = time.perf_counter() - start
+    assert np.array_equal(diff, loop_diff) and np.allclose(mean, loop_mean)
+    start = time.perf_counter()
+    analytics.rolling_mean(diff, 7)
+    analytics.rolling_mean(diff, 14, align='centered')
+    analytics.doubling_time(cases)
+    extra_seconds = time.perf_counter() - start
+    return {'shape': list(cases.shape), 'loop_seconds': loop_seconds,
+            'vectorized_seconds': vectorized_seconds, 'speedup': loop_seconds / vectorized_seconds,
+            'trailing_centered_doubling_seconds': extra_seconds}
+
+
+def _records_frame(docs):
+    """The original `fetch_all_data_as_df._work` path: dicts, `from_records`, then column drops"""
+    df = pd.DataFrame.from_records(docs)
+    df.drop([c for c in df.columns if c.startswith('_')], axis=1, inplace=True)
+    df.columns = map(str.lower, df.columns)
+    return df
+
+
+def _measure(func):
+    """Returns the result, wall seconds and traced peak MB of `func`; timed in a separate
+    untraced call since tracing slows down allocation-heavy code unevenly
+    """
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    result = func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return result, {'seconds': elapsed, 'peak_mb': peak / 2**20}
+
+
+def bench_load(args):
+    """Builds the states DataFrame at each of `--load-sizes` documents with the original
+    list-of-dicts path and with the batched column construction of `database.query`.
+    `construction` decodes pre-encoded BSON batches, isolating client CPU and memory from the
+    server; `end_to_end` reads the `--mongo-uri` mongod (skipped with `--mongomock`, whose cost
+    would dominate).
+    """
+    dtypes = {k: database._dtypes[t] for k, t in database.field_types['states'].items()}
+    collection = database.client.get_database('states').get_collection('states')
+    results = {}
+    for size in args.load_sizes:
+        df = synthetic_states(years=size / 56 / 365 + 1 / 365).head(size)
+        batch = database.QUERY_BATCH_SIZE
+        # what each path receives: whole documents, or the server-side projection without
+        # `_id` and `_hash`
+        raw, projected = [], []
+        for i in range(0, size, batch):
+            docs = df.iloc[i:i + batch].to_dict('records')
+            projected.append(b''.join(map(bson.encode, docs)))
+            raw.append(b''.join(bson.encode({'_id': bson.ObjectId(), **d, '_hash': ''})
+                                for d in docs))
+        del df, docs
+        results[size] = {'construction': {}, 'end_to_end': {}}
+        timing = results[size]['construction']
+        records, timing['records'] = _measure(
+            lambda: _records_frame([d for r in raw for d in bson.decode_all(r)]))
+        columnar, timing['columnar'] = _measure(lambda: pd.DataFrame(database.columns_from_batches(
+            (bson.decode_all(r) for r in projected), dtypes)))
+        assert len(records) == len(columnar) == size
+        if args.mongomock:
+            continue
+        collection.drop()
+        for r in raw:
+            collection.insert_many(bson.decode_all(r))
+        timing = results[size]['end_to_end']
+        _, timing['records'] = _measure(lambda: _records_frame(list(collection.find())))
+        _, timing['columnar'] = _measure(lambda: database.query('states'))
+    collection.drop()
+    return results
+
+
+def _connect(mongo):
+    """Points `database` and `data_acquire` at `mongo`, a MongoDB URI or `MONGOMOCK`"""
+    if mongo == MONGOMOCK:
+        import mongomock
+        client = mongomock.MongoClient()
+    else:
+        import pymongo
+        client = pymongo.MongoClient(mongo)
+    database.client = data_acquire.client = client
+
+
+def _claim_scratch(client):
+    """Marks the mongod of `client` as the benchmarks' scratch server. Raises RuntimeError if it
+    already holds any of the served or acquirer databases without that mark, since the
+    benchmarks drop and rewrite them.
+    """
+    names = set(client.list_database_names()) & set(database.geo + [database.META_DB])
+    marker = client.get_database(database.META_DB).get_collection(SCRATCH_MARKER)
+    if names and marker.count_documents({}) == 0:
+        raise RuntimeError('refusing to benchmark a mongod holding data not written by the '
+                           'benchmarks ({}); use a scratch mongod'.format(', '.join(sorted(names))))
+    marker.update_one({'_id': 'scratch'}, {'$set': {'claimed': time.time()}}, upsert=True)
+
+
+def _seed(years=0.5, n_counties=300):
+    """Writes small synthetic us/states/counties collections and their derived daily counts, and
+    publishes a data version with its snapshot, like the acquirer does. The snapshot goes to a
+    fresh `snapshot.SNAPSHOT_DIR` so that the app never loads one written for another database.
+    """
+    for geo, df in synthetic_data(years=years, n_counties=n_counties).items():
+        collection = database.client.get_database(geo).get_collection(geo)
+        collection.drop()
+        collection.insert_many(df.to_dict('records'))
+        if geo in database.derived:
+            database.client.get_database(geo).get_collection(database.derived[geo]).drop()
+            data_acquire.update_derived(geo, df['date'].min().to_pydatetime(),
+                                        df['date'].max().to_pydatetime())
+    snapshot.SNAPSHOT_DIR = tempfile.mkdtemp(prefix='snapshot-bench-')
+    return data_acquire.publish()
+
+
+def _clear():
+    """Drops the served and derived collections and the data version document"""
+    for geo in database.geo:
+        database.client.get_database(geo).get_collection(geo).drop()
+        if geo in database.derived:
+            database.client.get_database(geo).get_collection(database.derived[geo]).drop()
+    database.client.get_database(database.META_DB).get_collection('version').drop()
+
+
+def _startup_worker(populated, mongo, queue, timeout=60):
+    """Imports `app` in a fresh process and reports seconds until import returns, the first
+    page is served, and (with data) the data is loaded
+    """
+    _connect(mongo)
+    if populated:
+        _seed()
+    else:
+        _clear()
+    start = time.perf_counter()
+    import app
+    timings = {'import_seconds': time.perf_counter() - start}
+    app.app.server.test_client().get('/')
+    timings['first_page_seconds'] = time.perf_counter() - start
+    while populated and not app.df_dict and time.perf_counter() - start < timeout:
+        time.sleep(0.01)
+    timings['data_ready_seconds'] = time.perf_counter() - start if app.df_dict else None
+    queue.put(timings)
+
+
+def _importtime(mongo, cache_dir):
+    """Imports `app` in a fresh interpreter under `python -X importtime` with the reference data
+    cache in `cache_dir`; returns the wall time, the cumulative import time of `app` and the
+    modules with the highest self time
+    """
+    if mongo == MONGOMOCK:
+        code = 'import mongomock, pymongo; client = mongomock.MongoClient(); '
+    else:
+        code = 'import pymongo; client = pymongo.MongoClient({!r}); '.format(mongo)
+    code += 'pymongo.MongoClient = lambda *args, **kwargs: client; import app'
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                          env=dict(os.environ, REFERENCE_CACHE_DIR=cache_dir),
+                          capture_output=True, text=True, timeout=300)
+    wall = time.perf_counter() - start
+    modules = []
+    for line in proc.stderr.splitlines():
+        fields = line[len('import time:'):].split('|')
+        if line.startswith('import time:') and len(fields) == 3 and fields[0].strip().isdigit():
+            modules.append((fields[2].strip(), int(fields[0]), int(fields[1])))
+    app_us = [cumulative for name, _, cumulative in modules if name == 'app']
+    return {'wall_seconds': wall,
+            'app_cumulative_seconds': app_us[0] / 1e6 if app_us else None,
+            'slowest_self_ms': {name: self_us / 1000 for name, self_us, _ in
+                                sorted(modules, key=lambda m: -m[1])[:10]}}
+
+
+def bench_startup(args):
+    """Measures app startup latency on an empty and on a populated database, each in its own
+    process, and the import time breakdown with a cold and a warm reference data cache.
+    `within_budget` is False when importing and serving the first page takes longer than
+    `--startup-budget` seconds, which makes the run exit with status 1.
+    """
+    results = {}
+    for case, populated in [('empty_db', False), ('populated_db', True)]:
+        results[case] = _run_worker(_startup_worker, populated, args.mongo)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        for case in ['importtime_cold_cache', 'importtime_warm_cache']:
+            results[case] = _importtime(args.mongo, cache_dir)
+    results['budget_seconds'] = args.startup_budget
+    results['within_budget'] = all(results[case]['first_page_seconds'] <= args.startup_budget
+                                   for case in ['empty_db', 'populated_db'])
+    return results
+
+
+def _percentiles(samples):
+    return {'p50_ms': 1000 * float(np.percentile(samples, 50)),
+            'p99_ms': 1000 * float(np.percentile(samples, 99))}
+
+
+def _run_worker(target, *args, timeout=WORKER_TIMEOUT):
+    """Runs `target(*args, queue)` in a fresh spawned process and returns what it puts on
+    `queue`. Raises RuntimeError if the process exits without reporting (e.g. on an exception)
+    or takes longer than `timeout` seconds.
+    """
+    context = multiprocessing.get_context('spawn')
+    results = context.Queue()
+    worker = context.Process(target=target, args=args + (results,))
+    worker.start()
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                if not worker.is_alive():
+                    try:        # what it put just before exiting may still be in flight
+                        return results.get(timeout=1)
+                    except queue.Empty:
+                        raise RuntimeError('{} exited with code {} without reporting'.format(
+                            target.__name__, worker.exitcode)) from None
+                if time.monotonic() > deadline:
+                    raise RuntimeError('{} did not report within {} seconds'.format(
+                        target.__name__, timeout))
+    finally:
+        worker.join(10)
+        if worker.is_alive():
+            worker.terminate()
+            worker.join()
+
+
+def _callbacks_worker(mongo, repeat, queue, timeout=300):
+    """Times every memoized `app` callback, including JSON serialization of its response, with
+    and without the figure cache, called with the arguments `load_data` warms the cache with
+    """
+    import plotly.io
+    app, version = _serving_app(mongo, 0.5, 300, timeout)
+    results = {}
+    # the time-series graphs also pass their (initially empty) relayout data
+    for callback, extra in [(app.cd, (None,)), (app.cd_stack, (None,)), (app.heat_map, ()),
+                            (app.county_heat_map, ())]:
+        hits = ('covid_figure_cache_total', (('callback', callback.__name__), ('result', 'hit')))
+        for mode, func in [('uncached', inspect.unwrap(callback)), ('cached', callback)]:
+            before = metrics.registry.counters[hits]
+            samples = []
+            for i in range(repeat):
+                t = time.perf_counter()
+                plotly.io.json.to_json_plotly(func(['cases', 'deaths'][i % 2], version, *extra))
+                samples.append(time.perf_counter() - t)
+            results.setdefault(callback.__name__, {})[mode] = _percentiles(samples)
+            results[callback.__name__][mode]['cache_hits'] = metrics.registry.counters[hits] - before
+    queue.put(results)
+
+
+def bench_callbacks(args):
+    """Reports p50/p99 latency of the figure callbacks with and without the figure cache"""
+    results = _run_worker(_callbacks_worker, args.mongo, args.repeat)
+    missed = [name for name, modes in results.items() if modes['cached']['cache_hits'] < args.repeat]
+    assert not missed, 'cached calls missed the figure cache: {}'.format(missed)
+    return results
+
+
+def _downsample_worker(mongo, years, repeat, queue, timeout=300):
+    """Reports JSON payload bytes and build/serialization time of the time-series callbacks at
+    full resolution, downsampled to the graph width, and zoomed in on the last 30 days
+    """
+    import plotly.io
+    app, _ = _serving_app(mongo, years, 10, timeout)
+    last = app.df_dict['us']['date'].max()
+    zoom = {'xaxis.range[0]': str(last - pd.Timedelta(days=30)), 'xaxis.range[1]': str(last)}
+    width = app.GRAPH_WIDTH
+    results = {'days': len(app.df_dict['us'])}
+    for callback in [app.cd, app.cd_stack]:
+        for mode, graph_width, relayout in [('full', None, None), ('downsampled', width, None),
+                                            ('zoomed', width, zoom)]:
+            app.GRAPH_WIDTH = graph_width
+            build, serialize = [], []
+            for i in range(repeat):
+                t = time.perf_counter()
+                fig = inspect.unwrap(callback)(['cases', 'deaths'][i % 2], None, relayout)
+                build.append(time.perf_counter() - t)
+                t = time.perf_counter()
+                payload = plotly.io.json.to_json_plotly(fig)
+                serialize.append(time.perf_counter() - t)
+            results.setdefault(callback.__name__, {})[mode] = {
+                'points': len(fig.data[0].x), 'payload_bytes': len(payload),
+                'build': _percentiles(build), 'serialize': _percentiles(serialize)}
+    app.GRAPH_WIDTH = width
+    queue.put(results)
+
+
+def bench_downsample(args):
+    """Compares payload size and serialization time of downsampled and full time series"""
+    return _run_worker(_downsample_worker, args.mongo, args.years, args.repeat)
+
+
+def _filtered_trends(df, states, label):
+    """Builds the state trends figure the naive way, filtering the long-format frame per state"""
+    import plotly.graph_objects as go
+    fig = go.Figure()
+    for state in states:
+        rows = df[df['state'] == state]
+        fig.add_trace(go.Scatter(x=rows['date'], y=rows[label], mode='lines', name=state))
+    return fig
+
+
+def _states_worker(mongo, years, repeat, queue, timeout=300):
+    """Times the state trends callback with every jurisdiction selected, against filtering the
+    long-format states frame per request
+    """
+    import plotly.io
+    app, _ = _serving_app(mongo, years, 10, timeout)
+    matrices = app.df_dict['states_matrix']
+    present = set(app.df_dict['states']['state'].unique())
+    selected = [name for name in matrices['states'] if name in present]
+    results = {'days': len(matrices['dates']), 'states_selected': len(selected)}
+    trends = inspect.unwrap(app.state_trends)
+    cases = [
+        ('matrix_cumulative', lambda label: trends(selected, label, 'cumulative')),
+        ('matrix_daily', lambda label: trends(selected, label, 'daily')),
+        ('filtered_cumulative', lambda label: _filtered_trends(app.df_dict['states'], selected,
+                                                               label)),
+    ]
+    for name, build in cases:
+        samples, payload = [], ''
+        for i in range(repeat):
+            t = time.perf_counter()
+            payload = plotly.io.json.to_json_plotly(build(['cases', 'deaths'][i % 2]))
+            samples.append(time.perf_counter() - t)
+        results[name] = dict(_percentiles(samples), payload_bytes=len(payload))
+    queue.put(results)
+
+
+def bench_states(args):
+    """Reports state trends callback latency and payload with all jurisdictions selected"""
+    return _run_worker(_states_worker, args.mongo, args.years, args.repeat)
+
+
+def _concurrency_worker(mongo, repeat, queue, threads=8, timeout=300):
+    """Calls the heat map callbacks from `threads` threads at once and checks that every figure
+    matches the serial one and that the shared `app.df_dict` frames are left untouched
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    app, _ = _serving_app(mongo, 0.5, 300, timeout)
+    before = {name: df.copy() for name, df in app.df_dict.items()
+              if isinstance(df, pd.DataFrame)}
+    results = {}
+    for callback in [app.heat_map, app.county_heat_map]:
+        func = inspect.unwrap(callback)
+        labels = [['cases', 'deaths'][i % 2] for i in range(repeat)]
+        expected = {label: func(label).to_json() for label in set(labels)}
+        t = time.perf_counter()
+        serial = [func(label).to_json() for label in labels]
+        serial_seconds = time.perf_counter() - t
+        with ThreadPoolExecutor(threads) as pool:
+            t = time.perf_counter()
+            parallel = list(pool.map(lambda label: func(label).to_json(), labels))
+            parallel_seconds = time.perf_counter() - t
+        results[callback.__name__] = {
+            'calls': repeat, 'threads': threads,
+            'serial_seconds': serial_seconds, 'parallel_seconds': parallel_seconds,
+            'consistent': all(fig == expected[label] for fig, label in zip(serial + parallel,
+                                                                            labels + labels))}
+    results['df_dict_unchanged'] = all(before[name].equals(app.df_dict[name]) and
+                                       list(before[name]) == list(app.df_dict[name])
+                                       for name in before)
+    queue.put(results)
+
+
+def bench_concurrency(args):
+    """Checks the heat map callbacks are safe to run concurrently and reports their throughput"""
+    results = _run_worker(_concurrency_worker, args.mongo, args.repeat)
+    assert results['df_dict_unchanged']
+    assert all(result['consistent'] for result in results.values() if isinstance(result, dict))
+    return results
+
+
+def _memory_mb():
+    """Returns this process's resident and proportional set sizes in MB (PSS splits shared pages
+    among the processes mapping them)
+    """
+    sizes = {}
+    with open('/proc/self/smaps_rollup') as f:
+        for line in f:
+            name, _, rest = line.partition(':')
+            if name in ('Rss', 'Pss'):
+                sizes[name.lower() + '_mb'] = int(rest.split()[0]) / 1024
+    return sizes
+
+
+def _snapshot_worker(directory, private, ready, done, queue):
+    """Loads the current snapshot in `directory`, either memory-mapped or copied into private
+    memory, reads every column and reports its memory once all workers hold their data
+    """
+    snapshot.SNAPSHOT_DIR = directory
+    df_dict = snapshot.load_snapshot()
+    if private:
+        df_dict = {geo: df.copy(deep=True) for geo, df in df_dict.items()}
+    for df in df_dict.values():
+        for name in df.select_dtypes('number'):
+            df[name].to_numpy().sum()
+    ready.wait()
+    queue.put(_memory_mb())
+    done.wait()
+
+
+def _snapshot_workers(directory, private, workers):
+    context = multiprocessing.get_context('spawn')
+    queue = context.Queue()
+    ready, done = context.Barrier(workers + 1), context.Event()
+    procs = [context.Process(target=_snapshot_worker,
+                             args=(directory, private, ready, done, queue))
+             for _ in range(workers)]
+    for proc in procs:
+        proc.start()
+    ready.wait()
+    sizes = [queue.get() for _ in procs]
+    done.set()
+    for proc in procs:
+        proc.join()
+    return {key: sum(size[key] for size in sizes) / workers for key in sizes[0]}
+
+
+def bench_snapshot(args):
+    """Writes a snapshot of `--years` of us and states history and the latest counties, as
+    `database.fetch_all_data_as_df` reads them, and compares how app workers get the data:
+    reading MongoDB (a small seeded sample with `--mongomock`, whose cost would dominate),
+    loading the memory-mapped snapshot, and the per-worker memory of `--workers` processes
+    holding mapped versus private copies of it
+    """
+    df_dict = synthetic_data(years=args.years)
+    for geo in database.LATEST_ONLY:
+        df = df_dict[geo]
+        df_dict[geo] = df[df['date'] == df['date'].max()].reset_index(drop=True)
+    rows = sum(len(df) for df in df_dict.values())
+    results = {'rows': rows,
+               'frames_mb': sum(df.memory_usage(deep=True).sum()
+                                for df in df_dict.values()) / 2**20}
+    previous = snapshot.SNAPSHOT_DIR
+    snapshot.SNAPSHOT_DIR = directory = tempfile.mkdtemp(prefix='snapshot-bench-')
+    try:
+        start = time.perf_counter()
+        snapshot.write_snapshot(df_dict, 1)
+        results['write_seconds'] = time.perf_counter() - start
+        results['disk_mb'] = sum(os.path.getsize(os.path.join(directory, '1', name))
+                                 for name in os.listdir(os.path.join(directory, '1'))) / 2**20
+        start = time.perf_counter()
+        loaded = snapshot.load_snapshot()
+        results['load_seconds'] = time.perf_counter() - start
+        results['equal'] = all(
+            loaded[geo].astype({name: df[name].dtype for name in df}).equals(df)
+            for geo, df in df_dict.items())
+        # empty frames, typed as `database.query` returns them and untyped, keep their dtypes
+        # and do not turn into categories
+        empty = {'typed': df_dict['counties'].iloc[:0].astype({'county': 'category',
+                                                              'state': 'category'}),
+                 'untyped': pd.DataFrame(columns=list(df_dict['counties'].columns))}
+        snapshot.write_snapshot(empty, 2)
+        loaded = snapshot.load_snapshot(2)
+        assert (loaded['typed'].dtypes.astype(str) == empty['typed'].dtypes.astype(str)).all()
+        assert not isinstance(loaded['untyped']['date'].dtype, pd.CategoricalDtype)
+        results['workers'] = {'count': args.workers,
+                              'mapped': _snapshot_workers(directory, False, args.workers),
+                              'private': _snapshot_workers(directory, True, args.workers)}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        snapshot.SNAPSHOT_DIR = previous
+    # the same comparison against MongoDB, on data small enough to seed
+    _seed()
+    directory = snapshot.SNAPSHOT_DIR
+    try:
+        start = time.perf_counter()
+        sample = database.fetch_all_data_as_df()
+        mongo = time.perf_counter() - start
+        start = time.perf_counter()
+        snapshot.load_snapshot()
+        results['seeded'] = {'rows': sum(len(df) for df in sample.values()),
+                             'mongo_seconds': mongo,
+                             'snapshot_seconds': time.perf_counter() - start}
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+        snapshot.SNAPSHOT_DIR = previous
+        _clear()
+    return results
+
+
+def _counties_geojson(fips):
+    """Returns a stand-in for the county boundaries, one small square per county in `fips`, so
+    the county map is served without downloading the real GeoJSON
+    """
+    features = []
+    for i, fip in enumerate(fips):
+        x, y = -125 + (i % 60), 25 + (i // 60) * 0.5
+        features.append({'type': 'Feature', 'id': '{:05d}'.format(fip), 'properties': {},
+                         'geometry': {'type': 'Polygon', 'coordinates': [
+                             [[x, y], [x + 1, y], [x + 1, y + 0.5], [x, y + 0.5], [x, y]]]}})
+    return {'type': 'FeatureCollection', 'features': features}
+
+
+def _serving_setup(mongo, years, n_counties):
+    """Prepares this process to serve `app` offline: seeds the database, and puts the figure
+    cache and a stand-in county GeoJSON in fresh directories. Returns the data version.
+    """
+    _connect(mongo)
+    os.environ['FIGURE_CACHE_DIR'] = tempfile.mkdtemp()
+    utils.REFERENCE_CACHE_DIR = tempfile.mkdtemp()
+    fips = synthetic_counties(years=1 / 365, n_counties=n_counties)['fips']
+    with open(os.path.join(utils.REFERENCE_CACHE_DIR, 'geojson-counties-fips.json'), 'w') as f:
+        json.dump(_counties_geojson(fips), f)
+    return _seed(years=years, n_counties=n_counties)
+
+
+def _load_app(timeout=300):
+    """Imports `app` and returns it once its first `load_data` is done, the figure cache warm-up
+    included. Raises RuntimeError if that fails or takes longer than `timeout` seconds.
+    """
+    import app
+    loads = ('covid_function_seconds', (('function', 'load_data'),))
+    deadline = time.monotonic() + timeout
+    while loads not in metrics.registry.histograms:
+        if time.monotonic() > deadline:
+            raise RuntimeError('app did not load its data within {} seconds'.format(timeout))
+        time.sleep(0.01)
+    if app.data_version is None:
+        raise RuntimeError('app failed to load its data')
+    return app
+
+
+def _serving_app(mongo, years, n_counties, timeout=300):
+    """Seeds the database and loads `app` like `_serving_setup` and `_load_app`; returns `app`
+    and the data version
+    """
+    version = _serving_setup(mongo, years, n_counties)
+    return _load_app(timeout), version
+
+
+def _server_worker(mongo, years, n_counties, queue, stop, timeout=300):
+    """Seeds the database, serves `app` on a free local port with a threaded server and reports
+    the port, the cold load (import until the data is loaded) and warm reload seconds
+    """
+    import werkzeug.serving
+    version = _serving_setup(mongo, years, n_counties)
+    start = time.perf_counter()
+    app = _load_app(timeout)
+    timings = {'cold_load_seconds': time.perf_counter() - start}
+    start = time.perf_counter()
+    app.load_data(version)
+    timings['warm_reload_seconds'] = time.perf_counter() - start
+    # one access log line per request would slow down the server under test
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = werkzeug.serving.make_server('127.0.0.1', 0, app.app.server, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    queue.put((server.server_port, version, timings))
+    stop.wait()
+    server.shutdown()
+
+
+def _dash_request(output, inputs, state=None):
+    """Returns the `_dash-update-component` request body the page sends to compute `output`
+    ('id.property') from `inputs` and `state` ({'id.property': value}), the first input having
+    changed
+    """
+    def prop(name, **extra):
+        component, prop = name.split('.')
+        return dict(id=component, property=prop, **extra)
+    return {'output': output, 'outputs': prop(output),
+            'inputs': [prop(name, value=value) for name, value in inputs.items()],
+            'changedPropIds': [next(iter(inputs))],
+            'state': [prop(name, value=value) for name, value in (state or {}).items()]}
+
+
+def _dash_requests(version):
+    """Returns the request bodies of every server-side figure callback, by callback name. The
+    time series and state heat map come with both labels in one response (the page switches
+    between them in the browser); the others take one request per label.
+    """
+    requests = {
+        'cd_figures': [_dash_request('cd-figures.data', {'data-version.data': version,
+                                                         'cd.relayoutData': None})],
+        'cd_stack_figures': [_dash_request('cd_stack-figures.data', {
+            'data-version.data': version, 'cd_stack.relayoutData': None})],
+        'heat_map_figures': [_dash_request('heat-map-by-state-figures.data', {
+            'data-version.data': version})]}
+    for label in ['cases', 'deaths']:
+        bodies = {
+            'county_heat_map': _dash_request('heat-map-by-county.figure', {
+                'county-label-radioitems.value': label, 'data-version.data': version}),
+            'state_trends': _dash_request('state-trends.figure', {
+                'state-dropdown.value': ['New York', 'California', 'Texas', 'Florida'],
+                'state-label.value': label, 'state-mode.value': 'daily',
+                'data-version.data': version})}
+        for name, body in bodies.items():
+            requests.setdefault(name, []).append(body)
+    return requests
+
+
+def _load_test(url, requests, clients, total):
+    """Sends `total` requests, cycling through `requests` ({name: [body]}), from `clients`
+    threads with a session each. Returns the overall throughput and per-name latency
+    percentiles, mean response bytes and error count.
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    import requests as http
+    local = threading.local()
+    calls = [(name, body) for name, bodies in requests.items() for body in bodies]
+    calls = [calls[i % len(calls)] for i in range(total)]
+
+    def send(call):
+        if not hasattr(local, 'session'):
+            local.session = http.Session()
+        start = time.perf_counter()
+        try:
+            response = local.session.post(url, json=call[1], timeout=60)
+            ok, size = response.status_code == 200, len(response.content)
+            sent = int(response.headers.get('Content-Length', size))
+        except http.RequestException:
+            ok, size, sent = False, 0, 0
+        return call[0], time.perf_counter() - start, ok, size, sent
+
+    with ThreadPoolExecutor(clients) as pool:
+        start = time.perf_counter()
+        responses = list(pool.map(send, calls))
+        wall = time.perf_counter() - start
+    results = {'clients': clients, 'requests': total, 'requests_per_second': total / wall,
+               'errors': sum(not r[2] for r in responses)}
+    results.update(_percentiles([r[1] for r in responses]))
+    for name in requests:
+        mine = [r for r in responses if r[0] == name]
+        results[name] = dict(_percentiles([r[1] for r in mine]),
+                             mean_bytes=float(np.mean([r[3] for r in mine])),
+                             mean_sent_bytes=float(np.mean([r[4] for r in mine])),
+                             errors=sum(not r[2] for r in mine))
+    return results
+
+
+def bench_http(args):
+    """Serves the app with seeded data in a separate process and load-tests its callbacks over
+    HTTP: the first request of each callback, then `--requests` requests at each of
+    `--clients` concurrent clients. Also reports the server's cold load and warm reload seconds.
+    """
+    import requests as http
+    context = multiprocessing.get_context('spawn')
+    queue, stop = context.Queue(), context.Event()
+    server = context.Process(target=_server_worker,
+                             args=(args.mongo, min(args.years, 1), 300, queue, stop))
+    server.start()
+    try:
+        port, version, results = queue.get(timeout=600)
+        url = 'http://127.0.0.1:{}/_dash-update-component'.format(port)
+        requests = _dash_requests(version)
+        results['first_request_ms'] = {}
+        for name, bodies in requests.items():
+            start = time.perf_counter()
+            http.post(url, json=bodies[0], timeout=60).raise_for_status()
+            results['first_request_ms'][name] = 1000 * (time.perf_counter() - start)
+        results['load'] = {clients: _load_test(url, requests, clients, args.requests)
+                           for clients in args.clients}
+    finally:
+        stop.set()
+        server.join()
+    return results
+
+
+def bench_metrics(args):
+    """Reports the overhead `metrics.timed` adds to each call and how long rendering `/metrics`
+    takes with a histogram per callback output and route, as the app has
+    """
+    def noop():
+        pass
+    calls = 100000
+    results = {}
+    for name, func in [('bare', noop), ('timed', metrics.timed('noop')(noop))]:
+        start = time.perf_counter()
+        for _ in range(calls):
+            func()
+        results[name + '_us'] = 1e6 * (time.perf_counter() - start) / calls
+    results['overhead_us'] = results['timed_us'] - results['bare_us']
+    registry = metrics.Registry()
+    for i in range(200):
+        labels = {'route': '/_dash-update-component', 'output': 'graph-{}.figure'.format(i)}
+        registry.observe('covid_http_request_seconds', i / 1000, **labels)
+        registry.observe('covid_http_response_bytes', i * 1000, metrics.BYTES_BUCKETS, **labels)
+        registry.inc('covid_http_requests_total', status=200, **labels)
+    start = time.perf_counter()
+    text = registry.render()
+    results['render_ms'] = 1000 * (time.perf_counter() - start)
+    results['render_lines'] = text.count('\n')
+    return results
+
+
+def _gunicorn_worker(mongo, years, n_counties, workers, port):
+    """Seeds the database and serves `app` with gunicorn as configured in `gunicorn.conf.py`,
+    with `workers` worker processes on local `port`. Data preloaded by the master is inherited
+    by the forked workers, mongomock's included.
+    """
+    import gunicorn.app.base
+
+    class Server(gunicorn.app.base.Application):
+        def init(self, parser, opts, args):
+            pass
+
+        def load_config(self):
+            self.load_config_from_file(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                    'gunicorn.conf.py'))
+            self.cfg.set('workers', workers)
+            self.cfg.set('bind', '127.0.0.1:{}'.format(port))
+            self.cfg.set('graceful_timeout', 5)
+
+        def load(self):
+            import wsgi
+            return wsgi.server
+
+    _serving_setup(mongo, years, n_counties)
+    Server().run()
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def bench_workers(args):
+    """Serves the app through gunicorn with each of `--worker-counts` worker processes and
+    load-tests it with `--requests` requests from the largest of `--clients`, reporting how
+    throughput scales. Also reports the bytes sent for each figure with response compression.
+    """
+    import requests as http
+    context = multiprocessing.get_context('spawn')
+    clients = max(args.clients)
+    results = {'cpus': os.cpu_count(), 'clients': clients}
+    for workers in args.worker_counts:
+        port = _free_port()
+        server = context.Process(target=_gunicorn_worker,
+                                 args=(args.mongo, min(args.years, 1), 300, workers, port))
+        server.start()
+        try:
+            base = 'http://127.0.0.1:{}'.format(port)
+            start = time.perf_counter()
+            while True:
+                try:
+                    http.get(base + '/', timeout=5).raise_for_status()
+                    break
+                except http.RequestException:
+                    if not server.is_alive() or time.perf_counter() - start > 600:
+                        raise
+                    time.sleep(0.1)
+            url = base + '/_dash-update-component'
+            response = http.post(url, json=_dash_request(
+                'data-version.data', {'data-version-interval.n_intervals': 1},
+                {'data-version.data': None}), timeout=60)
+            requests = _dash_requests(response.json()['response']['data-version']['data'])
+            # warm-up, so that no figure is drawn on a cache miss during the measurement
+            _load_test(url, requests, clients, len(requests) * 2 * workers)
+            results[workers] = _load_test(url, requests, clients, args.requests)
+        finally:
+            server.terminate()
+            server.join(60)
+    base = results[min(args.worker_counts)]['requests_per_second']
+    for workers in args.worker_counts:
+        results[workers]['speedup'] = results[workers]['requests_per_second'] / base
+    return results
+
+
+def _toggles_worker(mongo, years, repeat, queue, timeout=300):
+    """Reports the bytes of the callback responses of a page load, raw and as sent gzipped, and
+    what a cases/deaths toggle costs: for the graphs switched in the browser, the server work a
+    request per label would take (serving the cached figure), against none
+    """
+    import gzip
+    import plotly.io
+    app, version = _serving_app(mongo, years, 300, timeout)
+    client = app.app.server.test_client()
+    results = {'page_load': {}}
+    for name, bodies in _dash_requests(version).items():
+        response = client.post('/_dash-update-component', json=bodies[0],
+                               headers={'Accept-Encoding': 'gzip'})
+        sent = response.get_data()
+        raw = gzip.decompress(sent) if response.headers.get('Content-Encoding') else sent
+        results['page_load'][name] = {'bytes': len(raw), 'sent_bytes': len(sent)}
+    results['page_load']['total_sent_bytes'] = sum(r['sent_bytes']
+                                                   for r in results['page_load'].values())
+    results['toggle'] = {'requests': 0}
+    for callback, args in [(app.cd, (version, None)), (app.cd_stack, (version, None)),
+                           (app.heat_map, (version,))]:
+        samples = []
+        for i in range(repeat):
+            t = time.perf_counter()
+            gzip.compress(plotly.io.json.to_json_plotly(callback(['cases', 'deaths'][i % 2],
+                                                                 *args)).encode(),
+                          app.COMPRESS_LEVEL)
+            samples.append(time.perf_counter() - t)
+        results['toggle'][callback.__name__ + '_per_label_request'] = _percentiles(samples)
+    frames = json.loads(plotly.io.json.to_json_plotly(app.heat_map('cases', version)))['frames']
+    results['heat_map_frame_bytes'] = float(np.mean([len(plotly.io.json.to_json_plotly(frame))
+                                                      for frame in frames]))
+    queue.put(results)
+
+
+def bench_toggles(args):
+    """Reports bytes per page load and the cost of a cases/deaths toggle (see `_toggles_worker`)"""
+    return _run_worker(_toggles_worker, args.mongo, min(args.years, 1), args.repeat)
+
+
+def _with_issues(df, n=20, seed=1):
+    """Returns a copy of a `synthetic_counties` frame with `n` counties each made to go
+    backwards for a day, to report a dump (a jump of 50 days of cases) and to skip a day, and
+    the injected issues as a set of (county, date, check)
+    """
+    rng = np.random.default_rng(seed)
+    df = df.copy()
+    dates = np.sort(df['date'].unique())
+    counties = rng.permutation(df['county'].unique())
+    issues = set()
+    for i, check in enumerate(['backward', 'spike', 'missing']):
+        for county in counties[i * n:(i + 1) * n]:
+            # late enough for the spike check's window to have history
+            date = dates[rng.integers(data_acquire.QUALITY_WINDOW, len(dates) - 1)]
+            rows = df['county'] == county
+            if check == 'backward':
+                day = rows & (df['date'] == date)
+                df.loc[day, 'cases'] = df.loc[day, 'cases'] // 2
+            elif check == 'spike':
+                df.loc[rows & (df['date'] >= date), 'cases'] += 1000
+            else:
+                df = df[~(rows & (df['date'] == date))]
+            issues.add((county, pd.Timestamp(date), check))
+    return df, issues
+
+
+def _quality_flag_keys(geo):
+    collection = database.client.get_database(geo).get_collection(database.quality[geo])
+    return {tuple(flag[k] for k in database.keys[geo] + database.quality_keys)
+            for flag in collection.find({}, {'_id': 0})}
+
+
+def _incremental_quality(df, start):
+    """Ingests the states frame `df` once as a backfill and once a day at a time with
+    `ingest_delta` from its `start`-th day on, and returns the quality flags of each as sets
+    """
+    dates = np.sort(df['date'].unique())
+    flags = {}
+    with tempfile.TemporaryDirectory() as directory:
+        server = serve_directory(directory)
+        url = 'http://127.0.0.1:{}/us-states.csv'.format(server.server_port)
+        path = os.path.join(directory, 'us-states.csv')
+        mtime = time.time() - 3600
+        for mode in ['backfill', 'incremental']:
+            _clear()
+            database.client.get_database('states').get_collection(
+                database.quality['states']).drop()
+            data_acquire.client.get_database(database.META_DB).get_collection('ingest').drop()
+            database.ensure_schema(data_acquire.client)
+            if mode == 'backfill':
+                _write_fixture(df, path, mtime)
+                data_acquire.stream_ingest('states', url)
+            else:
+                for i, date in enumerate(dates[start:]):
+                    _write_fixture(df[df['date'] <= date], path, mtime + 60 * (i + 1))
+                    data_acquire.ingest_delta('states', url)
+            flags[mode] = _quality_flag_keys('states')
+        server.shutdown()
+    return flags
+
+
+def bench_quality(args):
+    """Times the data-quality checks on counties-scale data (3000 counties over `--years`, about
+    2.2M rows at 2 years) with injected issues (see `_with_issues`): `quality_flags` against
+    parsing the same file, the ingest stage it is part of, and how many injected issues were
+    flagged. Then ingests a 300-county file with `stream_ingest` and reports the share of its
+    time spent in `check_quality` (including the query and writing the flags). Last, checks
+    that ingesting a states file with a skipped day a day at a time flags the same as a
+    backfill of it.
+    """
+    results = {}
+    df, issues = _with_issues(synthetic_counties(years=args.years, n_counties=3000))
+    text = df.to_csv(index=False, date_format='%Y-%m-%d')
+    parsed, results['parse_seconds'] = _timed(data_acquire.filter_data, text)
+    flags, results['flags_seconds'] = _timed(data_acquire.quality_flags, parsed, 'counties',
+                                             parsed['date'].min())
+    results['rows'] = len(parsed)
+    results['flags_fraction_of_parse'] = results['flags_seconds'] / results['parse_seconds']
+    results['flags'] = {check: int(count) for check, count in flags['check'].value_counts().items()}
+    found = set(zip(flags['county'].astype(str), flags['date'], flags['check']))
+    results['injected'] = len(issues)
+    results['injected_found'] = len(issues & found)
+    results['other_flags'] = len(found - issues)
+    assert results['injected_found'] == results['injected'], sorted(issues - found)
+    del parsed, flags
+
+    df, _ = _with_issues(synthetic_counties(years=args.years, n_counties=300))
+    key = ('covid_function_seconds', (('function', 'check_quality'),))
+    with tempfile.TemporaryDirectory() as directory:
+        df.to_csv(os.path.join(directory, 'counties.csv'), index=False, date_format='%Y-%m-%d')
+        server = serve_directory(directory)
+        _clear()
+        database.client.get_database('counties').get_collection(
+            database.quality['counties']).drop()
+        database.ensure_schema(data_acquire.client)
+        before = metrics.registry.histograms[key].sum if key in metrics.registry.histograms else 0
+        start = time.perf_counter()
+        data_acquire.stream_ingest('counties', 'http://127.0.0.1:{}/counties.csv'.format(
+            server.server_port))
+        elapsed = time.perf_counter() - start
+        quality = metrics.registry.histograms[key].sum - before
+        server.shutdown()
+    results['ingest'] = {'rows': len(df), 'seconds': elapsed, 'check_quality_seconds': quality,
+                         'check_quality_fraction': quality / elapsed}
+
+    df = synthetic_states(years=0.2)
+    gap = np.sort(df['date'].unique())[50]
+    flags = _incremental_quality(df[~((df['state'] == 'Texas') & (df['date'] == gap))], 45)
+    results['incremental'] = {mode: len(keys) for mode, keys in flags.items()}
+    assert flags['incremental'] == flags['backfill'], flags['incremental'] ^ flags['backfill']
+    assert (pd.Timestamp(gap), 'Texas', 'cases', 'missing') in flags['incremental']
+    _clear()
+    return results
+
+
+BENCHMARKS = {
+    'upsert': bench_upsert,
+    'indexes': bench_indexes,
+    'delta': bench_delta,
+    'download': bench_download,
+    'pipeline': bench_pipeline,
+    'parse': bench_parse,
+    'fips': bench_fips,
+    'geo': bench_geo,
+    'analytics': bench_analytics,
+    'load': bench_load,
+    'startup': bench_startup,
+    'callbacks': bench_callbacks,
+    'concurrency': bench_concurrency,
+    'downsample': bench_downsample,
+    'states': bench_states,
+    'snapshot': bench_snapshot,
+    'http': bench_http,
+    'metrics': bench_metrics,
+    'workers': bench_workers,
+    'toggles': bench_toggles,
+    'quality': bench_quality,
+}
+
+
+def _timings(results, path=()):
+    """Yields the (path, value) of every timing in `results`, i.e. every number under a key
+    ending in `_seconds` or `_ms`
+    """
+    for key, value in results.items():
+        if isinstance(value, dict):
+            yield from _timings(value, path + (str(key),))
+        elif str(key).endswith(('_seconds', '_ms')) and isinstance(value, (int, float)):
+            yield '.'.join(path + (str(key),)), value
+
+
+def compare(results, baseline, tolerance):
+    """Returns the timings in `results` that are more than `tolerance` (a fraction) slower than
+    the same timings in `baseline`, as {path: [baseline, current]}
+    """
+    before = dict(_timings(baseline))
+    return {path: [before[path], value] for path, value in _timings(results)
+            if before.get(path) and value > before[path] * (1 + tolerance)}
+
+
+def _commit():
+    """Returns the checked out git commit, or None outside a git checkout"""
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('names', nargs='*', metavar='name',
+                        help='benchmarks to run: {} (default: all)'.format(', '.join(BENCHMARKS)))
+    parser.add_argument('--years', type=float, default=3, help='history length of synthetic data')
+    parser.add_argument('--fips-rows', type=int, default=1000000, help='rows for the fips benchmark')
+    parser.add_argument('--load-sizes', type=lambda x: [int(n) for n in x.split(',')],
+                        default=[10000, 100000, 2000000], help='comma separated document counts')
+    parser.add_argument('--repeat', type=int, default=20, help='calls per callback and mode')
+    parser.add_argument('--workers', type=int, default=4, help='app worker processes to simulate')
+    parser.add_argument('--mongomock', action='store_true', help='use an in-memory mongomock client')
+    parser.add_argument('--mongo-uri', help='URI of a scratch mongod the benchmarks may overwrite')
+    parser.add_argument('--startup-budget', type=float, default=5.0,
+                        help='seconds allowed from importing app to serving the first page')
+    parser.add_argument('--clients', type=lambda x: [int(n) for n in x.split(',')],
+                        default=[1, 8], help='comma separated concurrent clients of the http test')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='requests per client count of the http test and per worker count')
+    parser.add_argument('--worker-counts', type=lambda x: [int(n) for n in x.split(',')],
+                        default=[1, 2, 4], help='comma separated gunicorn worker counts')
+    parser.add_argument('--output', help='also write the results with run metadata to this file')
+    parser.add_argument('--compare', metavar='BASELINE',
+                        help='results file of an earlier run to report timing regressions against')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='fraction a timing may exceed its baseline before it is reported')
+    args = parser.parse_args()
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {}'.format(', '.join(sorted(unknown))))
+    if not args.mongomock and not args.mongo_uri:
+        parser.error('one of --mongomock or --mongo-uri is required')
+    args.mongo = MONGOMOCK if args.mongomock else args.mongo_uri
+    _connect(args.mongo)
+    if not args.mongomock:
+        _claim_scratch(database.client)
+    results = {name: BENCHMARKS[name](args) for name in args.names or BENCHMARKS}
+    # through JSON, so that results compare the same as when read back from a file
+    results = json.loads(json.dumps(results, default=str))
+    print(json.dumps(results, indent=2))
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'commit': _commit(), 'created': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                       'args': vars(args), 'results': results}, f, indent=2, default=str)
+    regressions = {}
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(results, json.load(f)['results'], args.tolerance)
+        print(json.dumps({'regressions': regressions}, indent=2))
+    if regressions or any(result.get('within_budget') is False for result in results.values()):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
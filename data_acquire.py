@@ -2,25 +2,53 @@
 covid-19 data, US, New York Times
 """
 import time
-import sched
+import json
+import queue
+import random
+import argparse
+import threading
+import collections
+import contextlib
+import hashlib
+import datetime
 import pandas as pd
 import numpy as np
 import logging
 import requests
 import pymongo
+from requests.adapters import HTTPAdapter
 from io import StringIO
 import utils
+import database
+import analytics
+import snapshot
+import metrics
 
 
 MAX_DOWNLOAD_ATTEMPT = 10
 
 urls = {'us': 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us.csv', 
-        'states': 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-states.csv'}
+        'states': 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-states.csv',
+        'counties': 'https://raw.githubusercontent.com/nytimes/covid-19-data/master/us-counties.csv'}
 
-filters = {'us': ['date'],
-           'states': ['date', 'state']}
+filters = database.keys
 
 DOWNLOAD_PERIOD = 24*3600         # second --> every 24 hrs
+DOWNLOAD_TIMEOUT = 0.5            # second; connect and between-bytes read timeout
+DOWNLOAD_TIMEOUTS = {'counties': 5}   # second; per-source overrides of `DOWNLOAD_TIMEOUT`
+DOWNLOAD_WORKERS = 4              # sources downloaded concurrently
+BACKOFF_BASE = 0.5                # second; retry delays grow as BACKOFF_BASE * 2**attempt,
+BACKOFF_CAP = 30                  # second; capped, with full jitter
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+SOURCE_PERIODS = {}               # second; per-source overrides of `DOWNLOAD_PERIOD`
+PIPELINE_QUEUE_SIZE = 4           # items buffered between ingest pipeline stages
+DERIVED_WINDOWS = [7, 14]         # days of the rolling means kept in the derived collections
+REVISION_WINDOW = 14              # days before the last ingested date that are re-parsed, since
+                                  # NYT revises recent history
+QUALITY_WINDOW = 28               # days of daily changes that a day's change is compared with
+SPIKE_ZSCORE = 6                  # daily changes this many standard deviations above are spikes
+SPIKE_MIN_STD = 3                 # floor of that standard deviation, so sparse series are not
+                                  # all spikes
 
 logger = logging.Logger(__name__)
 
@@ -28,69 +56,685 @@ utils.setup_logger(logger, 'data.log')
 
 client = pymongo.MongoClient()
 
-def download_data(url=urls['us'], retries=MAX_DOWNLOAD_ATTEMPT):
-    """Returns covid cases and deaths data in the US from `urls` that includes multiple links
-    Returns None if network failed
+# one keep-alive connection pool shared by every download, gzip-encoded in transit
+session = requests.Session()
+adapter = HTTPAdapter(pool_connections=DOWNLOAD_WORKERS, pool_maxsize=DOWNLOAD_WORKERS)
+session.mount('http://', adapter)
+session.mount('https://', adapter)
+session.headers['Accept-Encoding'] = 'gzip'
+
+# explicit parse dtypes; counts are read nullable so rows with empty cells can be dropped, then
+# narrowed to int32
+CSV_DTYPES = {'state': 'category', 'county': 'category',
+              'fips': 'Int32', 'cases': 'Int32', 'deaths': 'Int32'}
+COUNT_COLUMNS = ['fips', 'cases', 'deaths']
+PARSE_CHUNK_ROWS = 100000         # rows per parsed chunk when streaming
+
+HASH_FIELD = database.HASH_FIELD  # per-document content digest used to skip unchanged rows
+BULK_BATCH_SIZE = 1000            # operations per `bulk_write` round trip
+
+def backoff_delay(attempt):
+    """Returns the seconds to wait before retry number `attempt` (from 0): exponential, capped at
+    `BACKOFF_CAP`, with full jitter so that failing sources do not retry in lockstep
+    """
+    return random.uniform(0, min(BACKOFF_CAP, BACKOFF_BASE * 2 ** attempt))
+
+
+def _get(url, retries=MAX_DOWNLOAD_ATTEMPT, timeout=DOWNLOAD_TIMEOUT, **kwargs):
+    """GETs `url` through the shared `session`, retrying network errors and `RETRY_STATUSES`
+    with `backoff_delay`. Returns the `Response`, or None once retries run out or the server
+    answers with any other error status.
     """
-    text = None
     for i in range(retries):
         try:
-            req = requests.get(url, timeout=0.5)
+            req = session.get(url, timeout=timeout, **kwargs)
             req.raise_for_status()
-            text = req.text
+            return req
         except requests.exceptions.HTTPError as e:
+            # a streamed body is never read, so its connection returns to the pool only on close
+            e.response.close()
+            if e.response.status_code not in RETRY_STATUSES:
+                logger.error("Giving up on HTTP Error: {}".format(e))
+                return None
             logger.warning("Retry on HTTP Error: {}".format(e))
-    if text is None:
-        logger.error('download_data too many FAILED attempts')
-    return text
+        except requests.exceptions.RequestException as e:
+            logger.warning("Retry on network error: {}".format(e))
+        if i + 1 < retries:
+            time.sleep(backoff_delay(i))
+    logger.error('{}: too many FAILED attempts'.format(url))
+    return None
 
 
-def filter_data(text):
-    """Converts `text` to `DataFrame`, removes empty lines and descriptions
+def download_data(url=urls['us'], retries=MAX_DOWNLOAD_ATTEMPT, stream=False,
+                  timeout=DOWNLOAD_TIMEOUT):
+    """Returns covid cases and deaths data in the US from `urls` that includes multiple links
+    With `stream`, returns the undecoded response body as a readable stream instead of text, so
+    that it can be parsed chunk by chunk while downloading; the caller closes it, which releases
+    the connection even if parsing fails.
+    Returns None if network failed
     """
-    # use StringIO to convert string to a readable buffer
-    df = pd.read_csv(StringIO(text), delimiter=',')
+    req = _get(url, retries, timeout, stream=stream)
+    if req is None:
+        return None
+    if stream:
+        req.raw.decode_content = True       # undo gzip transfer encoding on the fly
+        return req.raw
+    return req.text
+
+
+def download_if_modified(url, etag=None, last_modified=None, retries=MAX_DOWNLOAD_ATTEMPT,
+                         timeout=DOWNLOAD_TIMEOUT):
+    """Conditional GET of `url` using the validators saved from the previous download
+    Returns the `Response` (status 304 when the file is unchanged), or None if network failed
+    """
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return _get(url, retries, timeout, headers=headers)
+
+
+def tail_text(text, since):
+    """Returns the header line of CSV `text` followed by only the rows dated on or after `since`
+    ('YYYY-MM-DD'). NYT files are sorted by date, so the cut point is found by bisecting over
+    line starts without splitting the whole text. A text without rows (a header with no line
+    break after it, or nothing at all) is returned as it is.
+    """
+    lo = text.find('\n') + 1
+    if lo == 0:
+        return text
+    header = text[:lo]
+    hi = len(text)
+    while lo < hi:
+        start = text.rfind('\n', lo - 1, (lo + hi) // 2) + 1     # start of the line at midpoint
+        if text[start:start + len(since)] < since:
+            end = text.find('\n', start)
+            lo = len(text) if end == -1 else end + 1
+        else:
+            hi = start
+    return header + text[lo:]
+
+
+def _clean(df):
     df.columns = df.columns.str.strip()             # remove space in columns name  
-    df['date'] = pd.to_datetime(df['date']) 
+    df['date'] = pd.to_datetime(df['date'], format='%Y-%m-%d')
+    rows = df.shape[0]
     df.dropna(inplace=True)             # drop rows with empty cells
+    metrics.inc('covid_dropped_rows_total', rows - df.shape[0], reason='empty_cell')
+    for column in COUNT_COLUMNS:
+        if column in df.columns:
+            df[column] = df[column].astype('int32')
     return df
 
-def upsert_data(df, geo='us'):
+
+def filter_data(text, chunksize=None):
+    """Converts `text` to `DataFrame`, removes empty lines and descriptions
+    `text` is either a string or a readable stream as returned by `download_data(stream=True)`.
+    With `chunksize`, returns an iterator of DataFrames of at most `chunksize` rows instead, so
+    memory use is bounded by the chunk rather than by the whole file.
+    """
+    # use StringIO to convert string to a readable buffer
+    buffer = StringIO(text) if isinstance(text, str) else text
+    if chunksize is None:
+        return _filter_all(buffer)
+    reader = pd.read_csv(buffer, delimiter=',', dtype=CSV_DTYPES, chunksize=chunksize)
+    return metrics.timed_iter((_clean(chunk) for chunk in reader), 'filter_data')
+
+
+@metrics.timed('filter_data')
+def _filter_all(buffer):
+    df = _clean(pd.read_csv(buffer, delimiter=',', dtype=CSV_DTYPES))
+    metrics.observe('covid_function_rows', len(df), buckets=metrics.ROWS_BUCKETS,
+                    function='filter_data')
+    return df
+
+
+def record_hash(record):
+    """Returns a stable digest of the content of `record`, excluding internal `_` fields
+    """
+    content = {k: v for k, v in record.items() if not k.startswith('_')}
+    payload = json.dumps(content, sort_keys=True, default=str)
+    return hashlib.md5(payload.encode()).hexdigest()
+
+
+def _stored_hashes(collection, df, keys):
+    """Returns {key tuple: stored hash} for documents in the date range covered by `df`
+    """
+    query = {'date': {'$gte': df['date'].min(), '$lte': df['date'].max()}}
+    projection = {**{k: 1 for k in keys}, HASH_FIELD: 1, '_id': 0}
+    return {tuple(doc.get(k) for k in keys): doc.get(HASH_FIELD)
+            for doc in collection.find(query, projection=projection)}
+
+
+@metrics.timed('upsert_data')
+def upsert_data(df, geo='us', bulk=True, batch_size=BULK_BATCH_SIZE):
+    """Upserts rows of `df` into the `geo` collection, keyed by `filters[geo]`
+    With `bulk`, rows whose content hash matches the stored one are skipped and the rest are
+    written with unordered `ReplaceOne` batches of `batch_size`; otherwise every row is written
+    with its own `replace_one` call. Returns a dict of inserted/updated/unchanged counts, the
+    range of dates written (`first_changed`, `last_changed`) and throughput in rows/sec.
+    """
+    start = time.perf_counter()
     db = client.get_database(geo)   
     collection = db.get_collection(geo) 
-    update_count = 0
-    for record in df.to_dict('records'):
-        #print(record)
-        result = collection.replace_one(
-            filter={_:record[_] for _ in filters[geo]},    # locate the document if exists
-            replacement=record,                         # latest document
-            upsert=True)                                # update if exists, insert if not
-        if result.matched_count > 0:
-            update_count += 1
-    print(f'{geo}:', 
-          f'rows={df.shape[0]}, update={update_count}, '
-          f'insert={df.shape[0]-update_count}')
-
-def update_once():
-    for geo, url in urls.items():
-        t = download_data(url)
-        df = filter_data(t)
-        upsert_data(df, geo)
+    keys = filters[geo]
+    stats = {'rows': df.shape[0], 'inserted': 0, 'updated': 0, 'unchanged': 0,
+             'first_changed': None, 'last_changed': None}
+    changed = []
+    if df.shape[0] > 0:
+        stored = _stored_hashes(collection, df, keys) if bulk else {}
+        ops = []
+        for record in df.to_dict('records'):
+            key = tuple(record[_] for _ in keys)
+            digest = record_hash(record)
+            if bulk and stored.get(key) == digest:
+                stats['unchanged'] += 1
+                continue
+            record[HASH_FIELD] = digest
+            changed.append(record['date'])
+            if bulk:
+                stats['inserted' if key not in stored else 'updated'] += 1
+                ops.append(pymongo.ReplaceOne(
+                    filter={_:record[_] for _ in keys},     # locate the document if exists
+                    replacement=record,                     # latest document
+                    upsert=True))                           # update if exists, insert if not
+                if len(ops) >= batch_size:
+                    collection.bulk_write(ops, ordered=False)
+                    ops = []
+            else:
+                result = collection.replace_one(
+                    filter={_:record[_] for _ in keys},
+                    replacement=record,
+                    upsert=True)
+                stats['updated' if result.matched_count > 0 else 'inserted'] += 1
+        if ops:
+            collection.bulk_write(ops, ordered=False)
+    if changed:
+        stats['first_changed'] = min(changed).to_pydatetime()
+        stats['last_changed'] = max(changed).to_pydatetime()
+    elapsed = time.perf_counter() - start
+    stats['seconds'] = elapsed
+    stats['rows_per_sec'] = stats['rows'] / elapsed if elapsed > 0 else float('inf')
+    for outcome in ['inserted', 'updated', 'unchanged']:
+        metrics.inc('covid_upserted_rows_total', stats[outcome], geo=geo, outcome=outcome)
+    logger.info('{}: rows={}, update={}, insert={}, unchanged={}, {:.0f} rows/sec'.format(
+        geo, stats['rows'], stats['updated'], stats['inserted'], stats['unchanged'],
+        stats['rows_per_sec']))
+    return stats
 
 
-def main_loop(timeout=DOWNLOAD_PERIOD):
-    scheduler = sched.scheduler(time.time, time.sleep)
+def _last_before(collection, group, date):
+    """Returns the latest document of each series of `collection` (each value of the `group`
+    fields) dated before `date`, with its cases and deaths
+    """
+    pipeline = [{'$match': {'date': {'$lt': date}}},
+                # matches the (state, date) index, so each series is read from its end
+                {'$sort': {**{k: 1 for k in group}, 'date': -1}},
+                {'$group': {'_id': {k: '$' + k for k in group} if group else None,
+                            **{k: {'$first': '$' + k} for k in ['date', 'cases', 'deaths']}}}]
+    return [{**(doc.pop('_id') or {}), **doc} for doc in collection.aggregate(pipeline)]
+
+
+def update_derived(geo, first, last):
+    """Recomputes the `database.derived` documents of `geo` (daily new cases and deaths and their
+    trailing rolling means) dated from `first` to `last` plus the longest window, i.e. only the
+    dates whose values depend on the cumulative counts written between `first` and `last`.
+    The daily differences start from the last report of each series before that range, so a
+    series that did not report in the window is not counted from 0.
+    Returns the number of derived documents written.
+    """
+    if geo not in database.derived or first is None:
+        return 0
+    lookback = datetime.timedelta(days=max(DERIVED_WINDOWS))
+    projection = {'_id': 0, HASH_FIELD: 0}
+    collection = client.get_database(geo).get_collection(geo)
+    docs = list(collection.find(
+        {'date': {'$gte': first - lookback, '$lte': last + lookback}}, projection=projection))
+    if len(docs) == 0:
+        return 0
+    group = [k for k in filters[geo] if k != 'date']
+    df = pd.DataFrame.from_records(_last_before(collection, group, first - lookback) + docs)
+    column = group[0] if group else '_geo'
+    if not group:
+        df[column] = geo
+    frames = []
+    for label in ['cases', 'deaths']:
+        dates, labels, cumulative = analytics.to_matrix(df, label, columns=column, fill=True)
+        new = analytics.daily_diff(cumulative)
+        values = {'new_' + label: new}
+        for window in DERIVED_WINDOWS:
+            values['new_{}_{}d'.format(label, window)] = analytics.rolling_mean(new, window)
+        frames.append(pd.DataFrame({k: v.ravel() for k, v in values.items()}))
+    _, _, reported = analytics.to_matrix(df, 'cases', columns=column)
+    derived = pd.concat([pd.DataFrame({'date': np.repeat(dates, len(labels)),
+                                       column: np.tile(labels, len(dates))})] + frames, axis=1)
+    # only days that were actually reported and whose windows include the written range
+    derived = derived[~np.isnan(reported.ravel()) & (derived['date'] >= first)]
+    if not group:
+        derived = derived.drop(columns=column)
+    collection = client.get_database(geo).get_collection(database.derived[geo])
+    ops = [pymongo.ReplaceOne(filter={_:record[_] for _ in filters[geo]},
+                              replacement=record, upsert=True)
+           for record in derived.to_dict('records')]
+    for i in range(0, len(ops), BULK_BATCH_SIZE):
+        collection.bulk_write(ops[i:i + BULK_BATCH_SIZE], ordered=False)
+    logger.info('{}: {} derived documents recomputed from {:%Y-%m-%d}'.format(
+        geo, len(ops), first))
+    return len(ops)
+
+
+def quality_flags(df, geo, first, window=QUALITY_WINDOW, threshold=SPIKE_ZSCORE):
+    """Returns the data-quality flags of the `geo` rows of `df` dated from `first`, computed for
+    every state or county at once on date x series arrays, as a DataFrame of the keys of the
+    flagged day with its `label` and `check`:
+    `backward`, a cumulative count below one reported before it;
+    `missing`, a day without report between the first and last report of a series, also dated
+    before `first` back to the previous report in `df`, since a report from `first` on ends the
+    gap;
+    `spike`, a daily change more than `threshold` standard deviations above the `window` days
+    before it.
+    Each flag has the reported `value` and the `corrected` one: the highest earlier count, the
+    last report, and the mean daily change of the window (with the z-score as `score`).
+    """
+    group = [k for k in filters[geo] if k != 'date']
+    start = df['date'].min()
+    rows = ((df['date'] - start) // pd.Timedelta(days=1)).to_numpy()
+    if group:
+        columns = df.groupby(group, observed=True, sort=False).ngroup().to_numpy()
+        _, firsts = np.unique(columns, return_index=True)
+        names = df[group].iloc[firsts].reset_index(drop=True)
+    else:
+        columns, names = np.zeros(df.shape[0], dtype=np.int64), pd.DataFrame(index=[0])
+    # a row per day, so that days nobody reported are gaps too
+    dates = pd.date_range(start, periods=rows.max() + 1, freq='D')
+    checked = dates.searchsorted(pd.Timestamp(first))
+    days = np.arange(len(dates))[:, np.newaxis]
+    flags = []
+    for label in ['cases', 'deaths']:
+        cumulative = np.full((len(dates), len(names)), np.nan)
+        cumulative[rows, columns] = df[label].to_numpy()
+        # the day after the last report before `first` of each series
+        last = np.max(np.where(np.isnan(cumulative[:checked]), -1, days[:checked]), axis=0,
+                      initial=-1)
+        gap = np.where(last >= 0, last + 1, checked)
+        backward, raised = analytics.backward_steps(cumulative)
+        change = analytics.daily_rate(raised)
+        score, mean = analytics.trailing_zscore(change, window, min_std=SPIKE_MIN_STD)
+        with np.errstate(invalid='ignore'):
+            spike = score > threshold
+        for check, mask, value, corrected, since in [
+                ('backward', backward, cumulative, raised, checked),
+                ('missing', analytics.missing_days(cumulative), cumulative,
+                 analytics.carry_forward(raised), gap),
+                ('spike', spike, change, mean, checked)]:
+            row, column = np.nonzero(mask & (days >= since))
+            frame = names.iloc[column].reset_index(drop=True)
+            frame.insert(0, 'date', dates[row])
+            frame['label'] = label
+            frame['check'] = check
+            frame['value'] = value[row, column]
+            frame['corrected'] = corrected[row, column]
+            frame['score'] = score[row, column] if check == 'spike' else np.nan
+            flags.append(frame)
+    return pd.concat(flags, ignore_index=True)
+
+
+@metrics.timed('check_quality')
+def check_quality(geo, first, last, window=QUALITY_WINDOW, threshold=SPIKE_ZSCORE):
+    """Quality stage: replaces the `quality_flags` of `geo` dated from `first` to `last` plus
+    `window` days, whose checks may change with the counts written in between, in its
+    `database.quality` collection, and upserts the `missing` flags of the gaps up to `first`
+    that are at most `window` days long. Returns the number of flags written.
+    """
+    if first is None:
+        return 0
+    last = last + datetime.timedelta(days=window)
+    df = database.query(geo, first - datetime.timedelta(days=window + 1), last,
+                        fields=['cases', 'deaths'])
+    records, earlier = [], []
+    if df.shape[0] > 0:
+        flags = quality_flags(df, geo, first, window, threshold)
+        for check, count in flags['check'].value_counts().items():
+            metrics.inc('covid_quality_flags_total', count, geo=geo, check=check)
+        records = flags.to_dict('records')
+        earlier = [r for r in records if r['date'] < first]
+        records = [r for r in records if r['date'] >= first]
+    collection = client.get_database(geo).get_collection(database.quality[geo])
+    collection.delete_many({'date': {'$gte': first, '$lte': last}})
+    for i in range(0, len(records), BULK_BATCH_SIZE):
+        collection.insert_many(records[i:i + BULK_BATCH_SIZE], ordered=False)
+    # flags before `first` sit among others that stay valid, so only these are replaced
+    flag_keys = database.keys[geo] + database.quality_keys
+    ops = [pymongo.ReplaceOne({k: r[k] for k in flag_keys}, r, upsert=True) for r in earlier]
+    for i in range(0, len(ops), BULK_BATCH_SIZE):
+        collection.bulk_write(ops[i:i + BULK_BATCH_SIZE], ordered=False)
+    logger.info('{}: {} quality flags from {:%Y-%m-%d}'.format(
+        geo, len(records) + len(earlier), first))
+    return len(records) + len(earlier)
 
-    def _worker():
+
+def fetch_source(geo, url=None, backfill=False):
+    """Download stage: conditional GET of `geo` using the validators saved by its last ingest,
+    or with `backfill`, an unconditional streamed GET of the whole file whose body is then read
+    by the parse stage. Returns (ingest state, `Response`); the response is None if the
+    download failed.
+    """
+    state = {} if backfill else database.get_ingest_state(geo, client)
+    url = url or urls[geo]
+    timeout = DOWNLOAD_TIMEOUTS.get(geo, DOWNLOAD_TIMEOUT)
+    if backfill:
+        return state, _get(url, timeout=timeout, stream=True)
+    return state, download_if_modified(url, state.get('etag'), state.get('last_modified'),
+                                       timeout=timeout)
+
+
+def parse_source(req, state, backfill=False, window=REVISION_WINDOW,
+                 chunksize=PARSE_CHUNK_ROWS):
+    """Parse stage: yields DataFrames of at most `chunksize` rows from a `fetch_source` response.
+    A backfill is parsed while it downloads; a delta is cut down to the rows within `window` days
+    of the last ingested date in `state` first. The response is closed once parsing ends, fails
+    or the generator is closed, so a streamed download never holds on to its connection.
+    """
+    with contextlib.closing(req):
+        if backfill:
+            req.raw.decode_content = True       # undo gzip transfer encoding on the fly
+            body = req.raw
+        else:
+            body = req.text
+            if state.get('last_date') is not None:
+                since = state['last_date'] - datetime.timedelta(days=window)
+                body = tail_text(body, since.strftime('%Y-%m-%d'))
+        yield from filter_data(body, chunksize=chunksize)
+
+
+def new_totals(state):
+    """Returns empty counts for `write_chunk` to add the chunks of one ingest run to"""
+    return {'rows': 0, 'inserted': 0, 'updated': 0, 'unchanged': 0,
+            'first_changed': None, 'last_changed': None, 'last_date': state.get('last_date')}
+
+
+def write_chunk(geo, df, totals):
+    """Write stage: upserts one parsed chunk of `geo` and adds its counts, range of changed
+    dates and latest date to `totals`
+    """
+    stats = upsert_data(df, geo)
+    for k in ['rows', 'inserted', 'updated', 'unchanged']:
+        totals[k] += stats[k]
+    for k, pick in [('first_changed', min), ('last_changed', max)]:
+        if stats[k] is not None:
+            totals[k] = stats[k] if totals[k] is None else pick(totals[k], stats[k])
+    if df.shape[0] > 0:
+        last_date = df['date'].max().to_pydatetime()
+        totals['last_date'] = max(last_date, totals['last_date'] or last_date)
+    return totals
+
+
+def finish_source(geo, req, totals, complete=True):
+    """Write stage, after the last chunk: recomputes the derived documents and the quality flags
+    over the changed dates, and if the whole file was ingested (`complete`), saves the
+    validators and the last date that the next delta starts from
+    """
+    update_derived(geo, totals['first_changed'], totals['last_changed'])
+    check_quality(geo, totals['first_changed'], totals['last_changed'])
+    if complete:
+        database.set_ingest_state(geo, client,
+                                  etag=req.headers.get('ETag'),
+                                  last_modified=req.headers.get('Last-Modified'),
+                                  last_date=totals['last_date'])
+
+
+def ingest_source(geo, url=None, backfill=False, window=REVISION_WINDOW,
+                  chunksize=PARSE_CHUNK_ROWS):
+    """Runs the download, parse and write stages of `geo` one after another. Returns the summed
+    `upsert_data` counts, with `not_modified` set when the server reports the file unchanged, or
+    None if the download failed.
+    """
+    state, req = fetch_source(geo, url, backfill)
+    if req is None:
+        return None
+    if req.status_code == 304:
+        logger.info('{}: not modified since last ingest'.format(geo))
+        return dict(new_totals(state), not_modified=True)
+    totals = new_totals(state)
+    # closed on a failed write too, which closes the response
+    with contextlib.closing(parse_source(req, state, backfill, window, chunksize)) as chunks:
+        for df in chunks:
+            write_chunk(geo, df, totals)
+    finish_source(geo, req, totals)
+    return totals
+
+
+def ingest_delta(geo, url=None, window=REVISION_WINDOW):
+    """Downloads `geo` only if it changed since the last ingest and upserts only the rows within
+    `window` days of the last ingested date; see `ingest_source`
+    """
+    return ingest_source(geo, url, window=window)
+
+
+def stream_ingest(geo, url=None, chunksize=PARSE_CHUNK_ROWS):
+    """Downloads, parses and upserts the whole `geo` file as a pipeline of `chunksize`-row chunks
+    so that memory stays flat regardless of file size; see `ingest_source`
+    """
+    return ingest_source(geo, url, backfill=True, chunksize=chunksize)
+
+
+@metrics.timed('publish')
+def publish():
+    """Writes the snapshot of the next data version that the app workers load, then publishes
+    that version, so that workers seeing it find the snapshot instead of all reading MongoDB at
+    once. The version is published without a snapshot if writing it fails. Returns the version.
+    """
+    df_dict = database.fetch_all_data_as_df()
+    version = (database.get_data_version(client) or 0) + 1
+    if df_dict is not None:
         try:
-            update_once()
-        except Exception as e:
-            logger.warning("main loop worker ignores exception and continues: {}".format(e))
-        scheduler.enter(timeout, 1, _worker)    # schedule the next event
+            snapshot.write_snapshot(df_dict, version)
+        except OSError as e:
+            logger.warning('snapshot of data version {} not written: {}'.format(version, e))
+    version = database.publish_data_version(client, version)
+    logger.info('published data version {}'.format(version))
+    return version
+
+
+class IngestPipeline:
+    """Download, parse and write stages running in their own threads, connected by bounded
+    queues of `queue_size` items, so sources overlap (one downloads while another is written)
+    and a slow stage holds back the stages before it instead of buffering whole files.
+    A source has at most one run in the pipeline at a time. Once the pipeline drains after a run
+    that changed data, a new data version is published with its snapshot (see `publish`) by a
+    publish thread of its own, so that no stage waits for it.
+    Each run records the seconds spent in each stage (`download`, `parse`, `write`), blocked on
+    the next stage's full queue (`*_blocked`), and end to end (`total`); `last_runs` keeps the
+    latest run of each source. A backfill's body is read while parsing, so its download time is
+    counted under `parse`.
+    """
+    def __init__(self, sources=urls, download_workers=DOWNLOAD_WORKERS,
+                 queue_size=PIPELINE_QUEUE_SIZE):
+        self.sources = sources
+        self.downloads = queue.Queue()      # at most one run per source
+        self.parses = queue.Queue(queue_size)
+        self.writes = queue.Queue(queue_size)
+        self.publishes = queue.Queue()      # whether data changed, once per drain of the pipeline
+        self.lock = threading.Condition()
+        self.running = set()
+        self.changed = self.succeeded = False
+        self.publishing = 0
+        self.last_runs = {}
+        for target in [self._download] * download_workers + [self._parse, self._write,
+                                                             self._publish]:
+            threading.Thread(target=target, name='ingest' + target.__name__, daemon=True).start()
+
+    def submit(self, geo, backfill=False):
+        """Queues a run of `geo`; returns False without queuing it if one is still in progress"""
+        with self.lock:
+            if geo in self.running:
+                return False
+            self.running.add(geo)
+        self.downloads.put({'geo': geo, 'backfill': backfill, 'start': time.perf_counter(),
+                            'timings': collections.Counter(), 'stats': None, 'error': None})
+        return True
+
+    def wait(self, timeout=None):
+        """Blocks until no run or publication is in progress; returns False on timeout"""
+        with self.lock:
+            return self.lock.wait_for(lambda: not self.running and not self.publishing, timeout)
+
+    def _put(self, stage, run, target, item):
+        t = time.perf_counter()
+        target.put(item)
+        run['timings'][stage + '_blocked'] += time.perf_counter() - t
+
+    def _done(self, run):
+        timings = run['timings']
+        timings['total'] = time.perf_counter() - run['start']
+        stats = run['stats']
+        if run['error'] is not None:
+            logger.warning('{}: ingest failed: {}'.format(run['geo'], run['error']))
+        logger.info('{}: {} rows, {} inserted, {} updated; {}'.format(
+            run['geo'], *(stats[k] if stats else 0 for k in ['rows', 'inserted', 'updated']),
+            ', '.join('{} {:.2f}s'.format(k, v) for k, v in sorted(timings.items()))))
+        for stage, seconds in timings.items():
+            metrics.observe('covid_ingest_stage_seconds', seconds, geo=run['geo'], stage=stage)
+        metrics.inc('covid_ingest_runs_total', geo=run['geo'],
+                    outcome='failed' if run['error'] is not None else 'succeeded')
+        # before the run counts as done, so that `wait` returns with the metrics written
+        dump_metrics()
+        with self.lock:
+            self.running.discard(run['geo'])
+            self.last_runs[run['geo']] = run
+            self.succeeded = self.succeeded or (stats is not None and run['error'] is None)
+            self.changed = self.changed or bool(stats and (stats['inserted'] or stats['updated']))
+            if not self.running:
+                if self.changed or self.succeeded:
+                    self.publishing += 1
+                    self.publishes.put(self.changed)
+                self.changed = self.succeeded = False
+            self.lock.notify_all()
+
+    def _publish(self):
+        while True:
+            changed = self.publishes.get()
+            try:
+                # unchanged data is published only if no version was yet, e.g. for a database
+                # filled before versions existed
+                if changed or database.get_data_version(client) is None:
+                    publish()
+            except Exception as e:
+                logger.warning('data version not published: {}'.format(e))
+            finally:
+                dump_metrics()
+                with self.lock:
+                    self.publishing -= 1
+                    self.lock.notify_all()
+
+    def _download(self):
+        while True:
+            run = self.downloads.get()
+            t = time.perf_counter()
+            try:
+                run['state'], run['req'] = fetch_source(run['geo'], self.sources[run['geo']],
+                                                        run['backfill'])
+            except Exception as e:
+                run['req'], run['error'] = None, e
+            run['timings']['download'] += time.perf_counter() - t
+            if run['req'] is None:
+                run['error'] = run['error'] or 'download failed'
+                self._done(run)
+            elif run['req'].status_code == 304:
+                run['stats'] = dict(new_totals(run['state']), not_modified=True)
+                self._done(run)
+            else:
+                self._put('download', run, self.parses, run)
+
+    def _parse(self):
+        while True:
+            run = self.parses.get()
+            run['stats'] = new_totals(run['state'])
+            chunks = parse_source(run['req'], run['state'], run['backfill'])
+            try:
+                while True:
+                    t = time.perf_counter()
+                    df = next(chunks, None)
+                    run['timings']['parse'] += time.perf_counter() - t
+                    if df is None:
+                        break
+                    self._put('parse', run, self.writes, (run, df))
+            except Exception as e:
+                run['error'] = e
+            finally:
+                chunks.close()
+            self._put('parse', run, self.writes, (run, None))    # end of the run
+
+    def _write(self):
+        while True:
+            run, df = self.writes.get()
+            t = time.perf_counter()
+            try:
+                if df is not None:
+                    if run['error'] is None:        # drop the rest of a failed run
+                        write_chunk(run['geo'], df, run['stats'])
+                else:
+                    finish_source(run['geo'], run['req'], run['stats'], run['error'] is None)
+            except Exception as e:
+                run['error'] = run['error'] or e
+            run['timings']['write'] += time.perf_counter() - t
+            if df is None:
+                self._done(run)
+
+
+def dump_metrics(path=metrics.METRICS_FILE):
+    """Writes the acquirer's metrics to `path` for a Prometheus textfile collector"""
+    try:
+        metrics.write(path)
+    except OSError as e:
+        logger.warning('metrics not written to {}: {}'.format(path, e))
+
+
+def next_run(period, now=None):
+    """Returns the first time after `now` that is a whole multiple of `period` seconds since the
+    epoch, so runs stay on fixed wall-clock times (e.g. 00:00 UTC daily) however long they take
+    """
+    now = time.time() if now is None else now
+    return (now // period + 1) * period
+
+
+def main_loop(timeout=DOWNLOAD_PERIOD):
+    """Ingests every source now, then at each wall-clock multiple of its period
+    (`SOURCE_PERIODS`, or `timeout`). A source still in the pipeline when it is due again skips
+    that run rather than overlapping it. A source without ingest state (never ingested in full)
+    is backfilled, so that its whole file is parsed as a stream rather than in memory.
+    """
+    database.ensure_schema(client)
+    pipeline = IngestPipeline()
+    periods = {geo: SOURCE_PERIODS.get(geo, timeout) for geo in urls}
+    due = {geo: time.time() for geo in urls}
+    while True:
+        now = time.time()
+        for geo in urls:
+            if due[geo] <= now:
+                full = not database.get_ingest_state(geo, client)
+                if not pipeline.submit(geo, backfill=full):
+                    logger.warning('{}: previous run still in progress, skipping'.format(geo))
+                due[geo] = next_run(periods[geo], now)
+        time.sleep(max(0, min(due.values()) - time.time()))
+
 
-    scheduler.enter(0, 1, _worker)              # start the first event
-    scheduler.run(blocking=True)
+def backfill(sources=urls):
+    """Ingests every source in full once through the pipeline and returns its `last_runs`"""
+    database.ensure_schema(client)
+    pipeline = IngestPipeline(sources)
+    for geo in sources:
+        pipeline.submit(geo, backfill=True)
+    pipeline.wait()
+    return pipeline.last_runs
 
 
 if __name__ == '__main__':
-    main_loop()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--backfill', action='store_true',
+                        help='ingest every source in full once and exit')
+    if parser.parse_args().backfill:
+        backfill()
+    else:
+        main_loop()
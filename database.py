@@ -1,63 +1,501 @@
+import sys
 import logging
+import operator
+import itertools
+import collections
+import concurrent.futures
+import bson
 import pymongo
+import numpy as np
 import pandas as pd
-import expiringdict
 import time
+import datetime
+import threading
 import utils
+import metrics
 
 client = pymongo.MongoClient()
 logger = logging.Logger(__name__)
 utils.setup_logger(logger, 'db.log')
-RESULT_CACHE_EXPIRATION = 10             # seconds
+RESULT_CACHE_EXPIRATION = 10             # seconds between data version checks of cached results
+RESULT_CACHE_MAX_ENTRIES = 32
+RESULT_CACHE_MAX_BYTES = 512 * 2**20
+VERSION_POLL_INTERVAL = 5                # seconds between data version checks
+QUERY_BATCH_SIZE = 10000                 # documents per cursor batch
+HASH_FIELD = '_hash'                     # per-document content digest written by the acquirer
 
-geo = ['us','states']
+geo = ['us','states','counties']
+META_DB = 'meta'                         # acquirer bookkeeping, not part of the served data
 
-def fetch_all_data():
-    ret_dict = {}
+# fields that identify a document in each geo; upserts filter on them
+keys = {'us': ['date'],
+        'states': ['date', 'state'],
+        'counties': ['date', 'state', 'county']}
+
+# secondary indexes for the app's access patterns; the unique `keys` index (leading on `date`)
+# already serves latest-date lookups
+indexes = {'us': [],
+           'states': [[('state', pymongo.ASCENDING), ('date', pymongo.DESCENDING)]],
+           'counties': [[('fips', pymongo.ASCENDING), ('date', pymongo.DESCENDING)]]}
+
+# collections of daily new counts and rolling means, maintained by the acquirer next to `geo`
+# in the same database and keyed like it
+derived = {'us': 'us_daily',
+           'states': 'states_daily'}
+
+# data-quality flags of each geo written by the acquirer's quality stage, next to `geo` in the
+# same database; a flag is keyed like the document it flags plus `quality_keys`
+quality = {i: i + '_quality' for i in geo}
+quality_keys = ['label', 'check']
+# flags read along with the data, for the dashboard to overlay
+QUALITY_OVERLAY = 'states'
+# geos read only on their latest date along with the data, the only one the dashboard maps
+LATEST_ONLY = ['counties']
+
+# BSON types enforced by the collection validators
+field_types = {'us': {'date': 'date', 'cases': 'number', 'deaths': 'number'},
+               'states': {'date': 'date', 'state': 'string', 'fips': 'number',
+                          'cases': 'number', 'deaths': 'number'},
+               'counties': {'date': 'date', 'county': 'string', 'state': 'string',
+                            'fips': 'number', 'cases': 'number', 'deaths': 'number'}}
+
+
+# DataFrame dtypes for the BSON types in `field_types`; other fields are inferred
+_dtypes = {'date': 'datetime64[ns]', 'string': 'category', 'number': 'int64'}
+
+
+def _validator(fields):
+    return {'$jsonSchema': {'bsonType': 'object',
+                            'required': list(fields),
+                            'properties': {k: {'bsonType': t} for k, t in fields.items()}}}
+
+
+def ensure_schema(mongo_client=None):
+    """Creates the unique `keys` index, the secondary `indexes` and a `field_types` validator for
+    every geo, and the unique `keys` index of its `derived` and `quality` collections.
+    Idempotent, so both the acquirer and the app call it at startup.
+    """
+    mongo_client = mongo_client or client
     for i in geo:
-        length = 0
-        while length == 0:
-            db = client.get_database(i)
-            collection = db.get_collection(i)
-            ret = list(collection.find())
-            ret_dict[i] = ret
-            length = len(ret)
-            if length == 0:
-                time.sleep(30)
-            logger.info(str(length) + ' documents read from the database.')
-        time.sleep(1)
-    return ret_dict
-
-_fetch_all_data_as_df_cache = expiringdict.ExpiringDict(max_len=10,
-                                                       max_age_seconds=RESULT_CACHE_EXPIRATION)
-
-
-def fetch_all_data_as_df(allow_cached=False):
-    """Converts list of dicts returned by `fetch_all_data` to DataFrame with ID removed
-    Actual job is done in `_worker`. When `allow_cached`, attempt to retrieve timed cached from
-    `_fetch_all_data_as_df_cache`; ignore cache and call `_work` if cache expires or `allow_cached`
-    is False.
+        db = mongo_client.get_database(i)
+        try:
+            try:
+                db.create_collection(i, validator=_validator(field_types[i]),
+                                     validationLevel='moderate')
+            except pymongo.errors.CollectionInvalid:
+                # exists already, possibly created just now by the acquirer or another worker
+                db.command({'collMod': i, 'validator': _validator(field_types[i]),
+                            'validationLevel': 'moderate'})
+        except (pymongo.errors.OperationFailure, NotImplementedError) as e:
+            logger.warning('{}: schema validator not applied: {}'.format(i, e))
+        collection = db.get_collection(i)
+        try:
+            collection.create_index([(k, pymongo.ASCENDING) for k in keys[i]],
+                                    unique=True, name='_'.join(keys[i]) + '_unique')
+        except pymongo.errors.OperationFailure as e:
+            logger.error('{}: unique index not created, duplicate documents? {}'.format(i, e))
+        for index in indexes[i]:
+            collection.create_index(index)
+        if i in derived:
+            db.get_collection(derived[i]).create_index(
+                [(k, pymongo.ASCENDING) for k in keys[i]], unique=True,
+                name='_'.join(keys[i]) + '_unique')
+        db.get_collection(quality[i]).create_index(
+            [(k, pymongo.ASCENDING) for k in keys[i] + quality_keys], unique=True,
+            name='_'.join(keys[i] + quality_keys) + '_unique')
+
+
+def iter_batches(cursor, batch_size=QUERY_BATCH_SIZE):
+    """Yields lists of up to `batch_size` documents from `cursor`, fetched `batch_size` at a time"""
+    batch = []
+    for doc in cursor.batch_size(batch_size):
+        batch.append(doc)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@metrics.timed('query')
+def query(geo_name, start=None, end=None, states=None, fields=None, derived_data=False,
+          allow_cached=False):
+    """Returns documents of `geo_name` as a typed DataFrame sorted by its `keys`
+    Dates between `start` and `end` (inclusive, either may be None), `states` (a list of state
+    names) and `fields` (a list of columns; the keys are always included) are pushed down to
+    MongoDB as the filter and projection, so `_id` and other internal fields never leave the
+    server. Documents are decoded a batch at a time, each batch turned into typed column arrays
+    (see `columns_from_batches`). With `derived_data`, reads the `derived` collection of `geo_name`
+    instead. With `allow_cached`, the result comes from `result_cache`, keyed by these
+    parameters; cached DataFrames are shared and must not be modified.
     """
+    if allow_cached:
+        key = ('query', geo_name, start, end, tuple(states) if states is not None else None,
+               tuple(fields) if fields is not None else None, derived_data)
+        return result_cache.get(key, lambda: query(geo_name, start, end, states, fields,
+                                                   derived_data))
+    criteria = {}
+    if start is not None or end is not None:
+        criteria['date'] = {}
+        if start is not None:
+            criteria['date']['$gte'] = pd.Timestamp(start).to_pydatetime()
+        if end is not None:
+            criteria['date']['$lte'] = pd.Timestamp(end).to_pydatetime()
+    if states is not None:
+        if 'state' not in keys[geo_name]:
+            raise ValueError('{} has no state field to filter on'.format(geo_name))
+        criteria['state'] = {'$in': list(states)}
+    if fields is None:
+        projection = {'_id': 0, HASH_FIELD: 0}
+    else:
+        projection = {'_id': 0, **{f: 1 for f in keys[geo_name] + list(fields)}}
+    db = client.get_database(geo_name)
+    collection = db.get_collection(derived[geo_name] if derived_data else geo_name)
+    sort = [(k, pymongo.ASCENDING) for k in keys[geo_name]]
+    # the time to read and decode batches, apart from building the columns out of them
+    batches = metrics.timed_iter(decoded_batches(collection, criteria, projection, sort),
+                                 'query.read_batches')
+    columns = columns_from_batches(batches,
+                                   {k: _dtypes[t] for k, t in field_types[geo_name].items()})
+    if columns is None:
+        if fields is None and not derived_data:
+            fields = [f for f in field_types[geo_name] if f not in keys[geo_name]]
+        return _empty_frame(keys[geo_name] + list(fields or []), field_types[geo_name])
+    df = pd.DataFrame(columns, copy=False)
+    df.columns = map(str.lower, df.columns)
+    return df
+
+
+def decoded_batches(collection, criteria, projection, sort, batch_size=QUERY_BATCH_SIZE):
+    """Yields lists of documents matching `criteria`, decoded from raw BSON batches with the C
+    decoder in one call per batch rather than one cursor step per document
+    """
+    try:
+        raw_batches = collection.find_raw_batches(criteria, projection=projection, sort=sort,
+                                                  batch_size=batch_size)
+    except NotImplementedError:         # e.g. mongomock; fall back to a regular cursor
+        yield from iter_batches(collection.find(criteria, projection=projection).sort(sort),
+                                batch_size)
+        return
+    for raw in raw_batches:
+        yield bson.decode_all(raw)
+
+
+def _empty_frame(columns, types):
+    """Returns a DataFrame without rows whose `columns` have the dtypes of their BSON `types`
+    (see `_dtypes`), float for the others, so that it behaves like a result with rows
+    """
+    return pd.DataFrame({c: pd.Series(dtype=_dtypes.get(types.get(c), 'float64'))
+                         for c in columns})
+
+
+def _to_array(values, dtype):
+    """Returns `values` (a sequence in which None marks a missing value) as a NumPy array of
+    `dtype`, except that integers with missing or non-integral values come back as float64
+    rather than being truncated
+    """
+    if dtype == 'datetime64[ns]':
+        return pd.DatetimeIndex(values).to_numpy()      # much faster than numpy's own parsing
+    if dtype == 'category' or isinstance(values[0], str):
+        return np.array(values, dtype=object)
+    if dtype == 'int64':
+        array = np.array(values)
+        return array.astype(np.int64) if array.dtype.kind in 'iu' else \
+            np.array(values, dtype=np.float64)
+    return np.array(values, dtype=dtype)
+
+
+def columns_from_batches(batches, dtypes):
+    """Transposes batches of decoded documents (see `decoded_batches`) into a dict of one NumPy
+    array per field, using `dtypes` ({field: dtype}, 'category' for strings) where given and
+    inferring the rest. Each batch is turned into one array per field, so the per-document cost
+    is that of the decoded dicts only. A field missing from a document is a missing value (NaN,
+    NaT or None), which makes an int64 field float64 (see `_to_array`).
+    Returns None if there are no documents.
+    """
+    chunks = {}
+    count = 0
+    for docs in batches:
+        for field in dict.fromkeys(itertools.chain.from_iterable(docs)):
+            if field not in chunks:
+                # absent from every earlier document
+                chunks[field] = [_to_array([None] * count, dtypes.get(field))] if count else []
+        for field, parts in chunks.items():
+            parts.append(_to_array(list(map(operator.methodcaller('get', field), docs)),
+                                   dtypes.get(field)))
+        count += len(docs)
+    if not count:
+        return None
+    columns = {}
+    for field, parts in chunks.items():
+        values = np.concatenate(parts)
+        # categories are set once on the whole column, so batches need not agree on them
+        columns[field] = pd.Categorical(values) if dtypes.get(field) == 'category' else values
+    return columns
+
+
+def latest_date(geo):
+    """Returns the latest date of `geo` (an index lookup), or None if it has no documents"""
+    doc = client.get_database(geo).get_collection(geo).find_one(
+        {}, projection={'date': 1, '_id': 0}, sort=[('date', pymongo.DESCENDING)])
+    return None if doc is None else doc['date']
+
+
+def fetch_derived_as_df(geo='us'):
+    """Returns the precomputed daily new cases and deaths of `geo` with their rolling means
+    (`new_cases_7d`, ...) as a DataFrame sorted by date
+    """
+    return query(geo, derived_data=True)
+
+
+def fetch_quality_as_df(geo='states'):
+    """Returns the data-quality flags of `geo` (see `data_acquire.check_quality`) as a DataFrame
+    sorted by its `keys`, with the `label` and `check` of each flag, the reported `value`, the
+    `corrected` one and the `score` of spikes
+    """
+    collection = client.get_database(geo).get_collection(quality[geo])
+    sort = [(k, pymongo.ASCENDING) for k in keys[geo] + quality_keys]
+    dtypes = {**{k: _dtypes[field_types[geo][k]] for k in keys[geo]},
+              **{k: 'category' for k in quality_keys}}
+    columns = columns_from_batches(decoded_batches(collection, {}, {'_id': 0}, sort), dtypes)
+    if columns is None:
+        return _empty_frame(keys[geo] + quality_keys + ['value', 'corrected', 'score'],
+                            {**field_types[geo], **{k: 'string' for k in quality_keys}})
+    return pd.DataFrame(columns, copy=False)
+
+
+def publish_data_version(mongo_client=None, version=None):
+    """Bumps the data version document, or raises it to `version`; the acquirer calls it after
+    every ingest that changed data so that readers know when to (re)load. Returns the new version.
+    """
+    mongo_client = mongo_client or client
+    bump = {'$inc': {'version': 1}} if version is None else {'$max': {'version': version}}
+    doc = mongo_client.get_database(META_DB).get_collection('version').find_one_and_update(
+        {'_id': 'data'},
+        {**bump, '$set': {'updated_at': datetime.datetime.utcnow()}},
+        upsert=True, return_document=pymongo.ReturnDocument.AFTER)
+    return doc['version']
+
+
+def get_data_version(mongo_client=None):
+    """Returns the published data version, or None if no ingest has completed yet"""
+    mongo_client = mongo_client or client
+    doc = mongo_client.get_database(META_DB).get_collection('version').find_one({'_id': 'data'})
+    return None if doc is None else doc['version']
+
+
+def watch_data_version(on_change, interval=VERSION_POLL_INTERVAL, current=None):
+    """Starts a daemon thread that calls `on_change(version)` once data is published and again
+    whenever the version changes; `current` is a version the caller already has loaded. It waits
+    on a change stream of the version document where the server supports one (replica sets) and
+    polls every `interval` seconds otherwise. Returns the thread.
+    """
+    def _open_stream():
+        try:
+            return client.get_database(META_DB).get_collection('version').watch(
+                [{'$match': {'documentKey._id': 'data'}}],
+                max_await_time_ms=int(interval * 1000))
+        except Exception as e:          # e.g. standalone mongod without change streams
+            logger.info('change stream unavailable, polling for data version: {}'.format(e))
+            return None
+
+    def _run():
+        last = current
+        stream = _open_stream()
+        while True:
+            try:
+                version = get_data_version()
+                if version is not None and version != last:
+                    on_change(version)
+                    last = version
+            except Exception as e:
+                logger.warning("data version watcher ignores exception and continues: {}".format(e))
+            try:
+                if stream is not None:
+                    stream.try_next()   # returns early on a change, else after `interval`
+                    continue
+            except pymongo.errors.PyMongoError:
+                stream = None
+            time.sleep(interval)
+
+    thread = threading.Thread(target=_run, name='data-version-watcher', daemon=True)
+    thread.start()
+    return thread
+
+
+def get_ingest_state(geo, mongo_client=None):
+    """Returns the acquirer's bookkeeping document for `geo` (HTTP validators, last ingested
+    date), or an empty dict before the first ingest
+    """
+    mongo_client = mongo_client or client
+    state = mongo_client.get_database(META_DB).get_collection('ingest').find_one({'_id': geo})
+    return state or {}
+
+
+def set_ingest_state(geo, mongo_client=None, **fields):
+    """Merges `fields` into the bookkeeping document for `geo`"""
+    mongo_client = mongo_client or client
+    mongo_client.get_database(META_DB).get_collection('ingest').update_one(
+        {'_id': geo}, {'$set': fields}, upsert=True)
+
+
+class ResultCache:
+    """LRU cache of query results keyed by query parameters and validated against the published
+    data version, which is re-read at most every `version_ttl` seconds.
+    An entry of an older version is served stale while a single background thread reloads it;
+    concurrent misses of the same key wait for one load instead of each querying MongoDB.
+    Entries are evicted least recently used first beyond `max_entries` or `max_bytes`.
+    """
+    def __init__(self, max_entries=RESULT_CACHE_MAX_ENTRIES, max_bytes=RESULT_CACHE_MAX_BYTES,
+                 version_ttl=RESULT_CACHE_EXPIRATION):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.version_ttl = version_ttl
+        self.metrics = collections.Counter()
+        self._entries = collections.OrderedDict()        # key -> (version, value, nbytes)
+        self._loading = {}                                # key -> (version, Future) in flight
+        self._lock = threading.Lock()
+        self._version = None
+        self._version_checked = None
+
+    def version(self):
+        """Returns the data version, re-reading it from MongoDB once `version_ttl` has passed"""
+        now = time.monotonic()
+        if self._version_checked is None or now - self._version_checked >= self.version_ttl:
+            self._version = get_data_version()
+            self._version_checked = now
+        return self._version
+
+    def get(self, key, loader, version=None):
+        """Returns the cached value of `key`, calling `loader()` to (re)load it when needed
+        With `version`, only a value loaded for that data version is served, never a stale one.
+        """
+        exact = version is not None
+        if not exact:
+            version = self.version()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] == version or not exact):
+                self._entries.move_to_end(key)
+                if entry[0] == version:
+                    self.metrics['hits'] += 1
+                    return entry[1]
+                self.metrics['stale_hits'] += 1
+                if key not in self._loading:
+                    future = concurrent.futures.Future()
+                    self._loading[key] = (version, future)
+                    threading.Thread(target=self._load, args=(key, loader, version, future),
+                                     daemon=True).start()
+                return entry[1]
+            loading = self._loading.get(key)
+            if loading is None or (exact and loading[0] != version):
+                self.metrics['misses'] += 1
+                future = concurrent.futures.Future()
+                if loading is None:
+                    self._loading[key] = (version, future)
+                owner = True
+            else:
+                self.metrics['collapsed_misses'] += 1
+                future = loading[1]
+                owner = False
+        if owner:
+            self._load(key, loader, version, future)
+        return future.result()
+
+    def _load(self, key, loader, version, future):
+        try:
+            value = loader()
+        except Exception as e:
+            logger.warning('result cache failed to load {}: {}'.format(key, e))
+            with self._lock:
+                self._unregister(key, future)
+            future.set_exception(e)
+            return
+        with self._lock:
+            self.metrics['loads'] += 1
+            self._entries[key] = (version, value, _nbytes(value))
+            self._entries.move_to_end(key)
+            self._evict()
+            self._unregister(key, future)
+        future.set_result(value)
+
+    def _unregister(self, key, future):
+        # a load for another version than the one in flight was never registered
+        if self._loading.get(key, (None, None))[1] is future:
+            del self._loading[key]
+
+    def _evict(self):
+        # the newest entry is always kept, even if it alone exceeds `max_bytes`
+        while len(self._entries) > 1 and (len(self._entries) > self.max_entries or
+                                          self.nbytes() > self.max_bytes):
+            self._entries.popitem(last=False)
+            self.metrics['evictions'] += 1
+
+    def nbytes(self):
+        return sum(entry[2] for entry in self._entries.values())
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns the counters plus hit ratio, entry count and cached bytes"""
+        with self._lock:
+            stats = dict(self.metrics)
+            stats['entries'] = len(self._entries)
+            stats['bytes'] = self.nbytes()
+        served = stats.get('hits', 0) + stats.get('stale_hits', 0)
+        lookups = served + stats.get('misses', 0) + stats.get('collapsed_misses', 0)
+        stats['hit_ratio'] = served / lookups if lookups else None
+        return stats
+
+
+def _nbytes(value):
+    """Returns the approximate memory footprint of a cached result"""
+    if isinstance(value, pd.DataFrame):
+        # deep, so that string columns count their strings rather than a pointer per row
+        return int(value.memory_usage(index=True, deep=True).sum())
+    if isinstance(value, dict):
+        return sum(_nbytes(v) for v in value.values())
+    return sys.getsizeof(value)
+
+
+result_cache = ResultCache()
+
+
+@metrics.registry.collector
+def _result_cache_metrics():
+    for stat, value in result_cache.stats().items():
+        if value is not None:
+            metrics.registry.set('covid_result_cache', value, stat=stat)
+
+
+def fetch_all_data_as_df(allow_cached=False, version=None):
+    """Returns every geo as a DataFrame built by `query`, only on its latest date for the geos
+    of `LATEST_ONLY`, plus the derived daily counts of the states as `states_daily` and the
+    quality flags of `QUALITY_OVERLAY` as `<geo>_quality`, or None if nothing is ingested yet
+    Actual job is done in `_work`. When `allow_cached`, the result comes from `result_cache` and
+    may be one data version stale while it is being refreshed, unless `version` requires that
+    data version; otherwise `_work` is called. Cached DataFrames are shared and must not be
+    modified.
+    """
+    @metrics.timed('fetch_all_data_as_df._work')
     def _work():
-        ret_dict = fetch_all_data()
-        if len(ret_dict) == 0:
+        df_dict = {i: query(i, start=latest_date(i)) if i in LATEST_ONLY else query(i)
+                   for i in geo}
+        if all(len(df) == 0 for df in df_dict.values()):
             return None
-        df_dict = {}
-        for geo, data in ret_dict.items():
-            df = pd.DataFrame.from_records(data)
-            df.drop('_id', axis=1, inplace=True)
-            df.columns = map(str.lower, df.columns)
-            df_dict[geo] = df
+        for i, df in df_dict.items():
+            logger.info(str(len(df)) + ' documents read from the database.')
+            metrics.observe('covid_function_rows', len(df), buckets=metrics.ROWS_BUCKETS,
+                            function='fetch_all_data_as_df._work')
+        df_dict[derived['states']] = fetch_derived_as_df('states')
+        df_dict[QUALITY_OVERLAY + '_quality'] = fetch_quality_as_df(QUALITY_OVERLAY)
         return df_dict
 
     if allow_cached:
-        try:
-            return _fetch_all_data_as_df_cache['cache']
-        except KeyError:
-            pass
-    ret = _work()
-    _fetch_all_data_as_df_cache['cache'] = ret
-    return ret
+        return result_cache.get(('fetch_all_data_as_df',), _work, version)
+    return _work()
 
 
 if __name__ == '__main__':
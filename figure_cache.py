@@ -0,0 +1,199 @@
+"""
+Cache of serialized Plotly figures shared by all app workers
+Figures are keyed by (function, arguments) under the data version loaded by the server, so a new
+data version invalidates every entry at once. Only calls whose arguments pass the function's
+`cacheable` check are stored, and at most `MAX_ENTRIES` per version, since the arguments come from
+the browser. Entries live in a Redis-compatible server when `REDIS_URL` is set and the `redis`
+package is installed, and in files under `FIGURE_CACHE_DIR` otherwise.
+"""
+import os
+import json
+import shutil
+import time
+import hashlib
+import inspect
+import logging
+import tempfile
+import functools
+import utils
+import metrics
+
+FIGURE_CACHE_DIR = os.environ.get('FIGURE_CACHE_DIR',
+                                  os.path.join(tempfile.gettempdir(), 'covid-tracker-figures'))
+REDIS_URL = os.environ.get('REDIS_URL')
+REDIS_EXPIRATION = 2 * 24 * 3600          # seconds; old versions are never read again
+KEEP_VERSIONS = 2                         # versions kept on disk: the new one, and the one
+                                          # before for the workers that have not loaded it yet
+MAX_ENTRIES = 256                         # figures stored per data version; later ones are
+                                          # drawn without the cache
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'figure.log')
+
+
+class DiskBackend:
+    """Stores each figure as a JSON file under `<directory>/<version>/`"""
+    def __init__(self, directory=FIGURE_CACHE_DIR):
+        self.directory = directory
+
+    def _path(self, version, key):
+        return os.path.join(self.directory, str(version), key + '.json')
+
+    def get(self, version, key):
+        try:
+            with open(self._path(version, key)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def set(self, version, key, value):
+        path = self._path(version, key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # best-effort bound: workers count and write concurrently, so it may be passed or hit
+        # slightly early; temporary files of writes in progress are not counted
+        stored = sum(name.endswith('.json') for name in os.listdir(os.path.dirname(path)))
+        if stored >= MAX_ENTRIES:
+            logger.warning('figure of data version {} not cached: {} entries stored'.format(
+                version, MAX_ENTRIES))
+            return
+        try:
+            utils.write_atomic(path, value)
+        except FileNotFoundError:
+            # another worker already removed this version (see `invalidate`); nothing to keep
+            logger.info('figure of data version {} not cached: version removed'.format(version))
+
+    def invalidate(self, keep_version):
+        """Removes the entries of the versions older than the last `KEEP_VERSIONS` up to
+        `keep_version`, so that workers still serving the previous version can keep caching it.
+        Newer versions, which faster workers may already be filling, are left alone.
+        """
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.isdigit() and int(name) <= int(keep_version) - KEEP_VERSIONS:
+                shutil.rmtree(os.path.join(self.directory, name), ignore_errors=True)
+
+
+class RedisBackend:
+    """Stores each figure under `figure:<version>:<key>` with an expiry instead of invalidation,
+    counting the entries of a version under `figure:<version>`. An unreachable server only
+    costs the cache: lookups miss and figures are not stored.
+    """
+    def __init__(self, url=REDIS_URL):
+        import redis
+        self.redis = redis.Redis.from_url(url)
+        self.errors = redis.RedisError
+
+    def get(self, version, key):
+        try:
+            value = self.redis.get('figure:{}:{}'.format(version, key))
+        except self.errors as e:
+            logger.warning('figure cache lookup failed: {}'.format(e))
+            return None
+        return None if value is None else value.decode()
+
+    def set(self, version, key, value):
+        try:
+            count = self.redis.incr('figure:{}'.format(version))
+            if count == 1:
+                self.redis.expire('figure:{}'.format(version), REDIS_EXPIRATION)
+            if count > MAX_ENTRIES:
+                logger.warning('figure of data version {} not cached: {} entries stored'.format(
+                    version, MAX_ENTRIES))
+                return
+            self.redis.set('figure:{}:{}'.format(version, key), value, ex=REDIS_EXPIRATION)
+        except self.errors as e:
+            logger.warning('figure not cached: {}'.format(e))
+
+    def invalidate(self, keep_version):
+        pass
+
+
+def _backend():
+    if REDIS_URL:
+        try:
+            return RedisBackend()
+        except ImportError:
+            logger.warning('REDIS_URL is set but redis is not installed; caching figures on disk')
+    return DiskBackend()
+
+
+backend = _backend()
+
+
+def _key(name, args):
+    payload = json.dumps([name, args], sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode()).hexdigest()
+
+
+def memoize(name, get_version, cacheable=None):
+    """Decorates the figure function `name` so that its figure is served from the cache for the
+    data version returned by `get_version()`. Nothing is cached while that is None (no data).
+    Entries are keyed by the arguments bound to their parameter names, defaults included, except
+    a `version` parameter: that is the version the browser last saw, while entries are stored
+    under the server's. Calls for which `cacheable(**arguments)` is false are not cached.
+    Hits and misses return the figure JSON as a dict, which Dash accepts in place of a `Figure`;
+    uncached calls return the `Figure` itself.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        def wrapper(*args):
+            version = get_version()
+            if version is None:
+                return func(*args)
+            arguments = signature.bind(*args)
+            arguments.apply_defaults()
+            arguments = dict(arguments.arguments)
+            arguments.pop('version', None)
+            if cacheable is not None and not cacheable(**arguments):
+                metrics.inc('covid_figure_cache_total', callback=name, result='uncacheable')
+                return func(*args)
+            key = _key(name, arguments)
+            cached = backend.get(version, key)
+            if cached is not None:
+                metrics.inc('covid_figure_cache_total', callback=name, result='hit')
+                return json.loads(cached)
+            metrics.inc('covid_figure_cache_total', callback=name, result='miss')
+            fig = func(*args)
+            start = time.perf_counter()
+            value = fig.to_json()
+            metrics.observe('covid_figure_serialize_seconds', time.perf_counter() - start,
+                            callback=name)
+            metrics.observe('covid_figure_bytes', len(value), buckets=metrics.BYTES_BUCKETS,
+                            callback=name)
+            backend.set(version, key, value)
+            # what a hit returns, so that Dash does not serialize the figure a second time
+            return json.loads(value)
+        return wrapper
+    return decorator
+
+
+@metrics.registry.collector
+def _hit_ratios():
+    lookups = {}
+    with metrics.registry.lock:
+        for (name, labels), count in metrics.registry.counters.items():
+            if name == 'covid_figure_cache_total':
+                labels = dict(labels)
+                lookups.setdefault(labels['callback'], {})[labels['result']] = count
+    for callback, counts in lookups.items():
+        cached = counts.get('hit', 0) + counts.get('miss', 0)
+        if cached:
+            metrics.registry.set('covid_figure_cache_hit_ratio', counts.get('hit', 0) / cached,
+                                 callback=callback)
+
+
+def warm(version, calls):
+    """Fills the cache for a new data `version` by invoking each memoized callback with each
+    argument tuple in `calls` ({callback: [args, ...]}), then drops older versions
+    """
+    for func, arg_list in calls.items():
+        for args in arg_list:
+            try:
+                func(*args)
+            except Exception as e:
+                logger.warning('figure cache warm-up of {} failed: {}'.format(func.__name__, e))
+    backend.invalidate(version)
+    logger.info('figure cache warmed for data version {}'.format(version))
@@ -0,0 +1,21 @@
+"""
+gunicorn settings of the production dashboard: `gunicorn -c gunicorn.conf.py wsgi:server`
+The master imports the app and loads the current data once, then forks the workers, which share
+it copy-on-write (the snapshot columns are shared memory maps anyway) and each start a thread
+that swaps in newly published data. Every worker serves `threads` requests at a time.
+"""
+import os
+
+os.environ['COVID_TRACKER_PRELOAD'] = '1'
+
+bind = os.environ.get('BIND', '0.0.0.0:8050')
+workers = int(os.environ.get('WEB_CONCURRENCY', 2 * (os.cpu_count() or 1)))
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS', 4))
+preload_app = True
+timeout = 120                   # seconds; generous for figures drawn on a cache miss
+
+
+def post_fork(server, worker):
+    import app
+    app.after_fork()
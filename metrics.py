@@ -0,0 +1,241 @@
+"""
+Process-wide latency, size and row count histograms plus counters in the Prometheus text format
+The app serves them at `/metrics` and the acquirer writes them to `METRICS_FILE` after each run,
+in the format read by the node exporter's textfile collector. With `PROFILE_SLOW_MS` set, the app
+samples the stack of every request and writes those slower than that to `PROFILE_DIR` as
+collapsed stacks (one `frame;frame;... count` line per stack), the input of flamegraph.pl and
+speedscope.
+"""
+import os
+import sys
+import time
+import bisect
+import logging
+import tempfile
+import threading
+import functools
+import itertools
+import collections
+import utils
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BYTES_BUCKETS = (1e3, 1e4, 3e4, 1e5, 3e5, 1e6, 3e6, 1e7)
+ROWS_BUCKETS = (1, 10, 100, 1e3, 1e4, 1e5, 1e6, 1e7)
+METRICS_FILE = os.environ.get('METRICS_FILE',
+                              os.path.join(tempfile.gettempdir(), 'covid-tracker-acquirer.prom'))
+PROFILE_SLOW_MS = float(os.environ.get('PROFILE_SLOW_MS', 0))   # 0 disables the profiler
+PROFILE_INTERVAL = 0.005          # seconds between stack samples
+PROFILE_DIR = os.environ.get('PROFILE_DIR',
+                             os.path.join(tempfile.gettempdir(), 'covid-tracker-profiles'))
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'metrics.log')
+
+
+class Histogram:
+    """Cumulative bucket counts, sum and count of the observed values"""
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)          # the last one is +Inf
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+def _labels(labels, **extra):
+    items = sorted({**dict(labels), **extra}.items())
+    if not items:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, str(v).replace('\\', r'\\').replace('"', r'\"'))
+                          for k, v in items) + '}'
+
+
+def _number(value):
+    return repr(float(value)) if value == value else 'NaN'
+
+
+class Registry:
+    """Histograms, counters and gauges keyed by name and labels. Collectors registered with
+    `collector` are called before rendering to refresh gauges computed from other state.
+    """
+    def __init__(self):
+        self.histograms = {}                             # (name, labels) -> Histogram
+        self.counters = collections.Counter()            # (name, labels) -> value
+        self.gauges = {}                                 # (name, labels) -> value
+        self.collectors = []
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram(buckets)
+            histogram.observe(value)
+
+    def inc(self, name, amount=1, **labels):
+        with self.lock:
+            self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = value
+
+    def collector(self, func):
+        """Registers `func()` to be called before every `render`; returns it, so it can be
+        used as a decorator
+        """
+        self.collectors.append(func)
+        return func
+
+    def render(self):
+        """Returns every metric in the Prometheus text exposition format"""
+        for func in self.collectors:
+            try:
+                func()
+            except Exception as e:
+                logger.warning('metrics collector {} failed: {}'.format(func.__name__, e))
+        lines = []
+        with self.lock:
+            groups = [('counter', sorted(self.counters.items())),
+                      ('gauge', sorted(self.gauges.items())),
+                      ('histogram', sorted(self.histograms.items(), key=lambda item: item[0]))]
+            for kind, items in groups:
+                for name, series in itertools.groupby(items, key=lambda item: item[0][0]):
+                    lines.append('# TYPE {} {}'.format(name, kind))
+                    for (_, labels), value in series:
+                        if kind != 'histogram':
+                            lines.append('{}{} {}'.format(name, _labels(labels), _number(value)))
+                            continue
+                        cumulative = 0
+                        for bound, count in zip(value.buckets + ('+Inf',), value.counts):
+                            cumulative += count
+                            le = bound if bound == '+Inf' else _number(bound)
+                            lines.append('{}_bucket{} {}'.format(name, _labels(labels, le=le),
+                                                                 cumulative))
+                        lines.append('{}_sum{} {}'.format(name, _labels(labels),
+                                                          _number(value.sum)))
+                        lines.append('{}_count{} {}'.format(name, _labels(labels), value.count))
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+observe = registry.observe
+inc = registry.inc
+render = registry.render
+
+
+def timed(function, family='covid_function'):
+    """Decorates a function to record its wall time in the `<family>_seconds` histogram, and
+    failures in the `<family>_errors_total` counter, labelled `function=<function>`
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                inc(family + '_errors_total', function=function)
+                raise
+            finally:
+                observe(family + '_seconds', time.perf_counter() - start, function=function)
+        return wrapper
+    return decorator
+
+
+def timed_iter(iterable, function, rows=len):
+    """Yields from `iterable` and, once it is exhausted, records the total time spent producing
+    its items in `covid_function_seconds` and their total `rows(item)` in `covid_function_rows`
+    """
+    elapsed, count = 0, 0
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            break
+        finally:
+            elapsed += time.perf_counter() - start
+        count += rows(item)
+        yield item
+    observe('covid_function_seconds', elapsed, function=function)
+    observe('covid_function_rows', count, buckets=ROWS_BUCKETS, function=function)
+
+
+def write(path=METRICS_FILE):
+    """Writes `render()` to `path` (see `utils.write_atomic`, so a scraper never reads half a
+    file)
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    utils.write_atomic(path, render())
+
+
+def _frame_name(frame):
+    return '{}:{}:{}'.format(frame.f_globals.get('__name__', '?'), frame.f_code.co_name,
+                             frame.f_code.co_firstlineno)
+
+
+class Profiler:
+    """Samples the stacks of the threads between `begin` and `end` every `interval` seconds from
+    one daemon thread, and writes the samples of those that took at least `slow_seconds`
+    """
+    def __init__(self, slow_seconds, directory=PROFILE_DIR, interval=PROFILE_INTERVAL):
+        self.slow_seconds = slow_seconds
+        self.directory = directory
+        self.interval = interval
+        self.active = {}                                 # thread id -> Counter of stacks
+        self.lock = threading.Lock()
+        self.pid = None
+
+    def begin(self):
+        """Starts sampling the calling thread, and the sampling thread on first use in this
+        process, so that workers forked from a preloading master get their own
+        """
+        with self.lock:
+            if self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.active = {}
+                threading.Thread(target=self._run, daemon=True).start()
+            self.active[threading.get_ident()] = collections.Counter()
+
+    def end(self, name, elapsed):
+        """Stops sampling the calling thread and writes its stacks to
+        `<directory>/<time>-<name>-<ms>ms.folded` if `elapsed` is at least `slow_seconds`.
+        Returns the file written, or None.
+        """
+        with self.lock:
+            stacks = self.active.pop(threading.get_ident(), None)
+        if not stacks or elapsed < self.slow_seconds:
+            return None
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, '{}-{}-{:.0f}ms.folded'.format(
+            time.strftime('%Y%m%dT%H%M%S'), ''.join(c if c.isalnum() else '_' for c in name),
+            1000 * elapsed))
+        with open(path, 'w') as f:
+            f.writelines('{} {}\n'.format(stack, count) for stack, count in stacks.items())
+        logger.info('{} took {:.0f} ms, stacks written to {}'.format(name, 1000 * elapsed, path))
+        return path
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                if not self.active:
+                    continue
+                frames = sys._current_frames()
+                for ident, stacks in self.active.items():
+                    frame, names = frames.get(ident), []
+                    while frame is not None:
+                        names.append(_frame_name(frame))
+                        frame = frame.f_back
+                    if names:
+                        stacks[';'.join(reversed(names))] += 1
+
+
+profiler = Profiler(PROFILE_SLOW_MS / 1000) if PROFILE_SLOW_MS > 0 else None
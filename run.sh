@@ -1,3 +1,5 @@
 pip3 install dash
 pip3 install dash-daq
-pip3 install jupyter pandas matplotlib
\ No newline at end of file
+pip3 install jupyter pandas matplotlib
+pip3 install gunicorn
+pip3 install flask-compress
@@ -0,0 +1,121 @@
+"""
+Immutable columnar snapshots of the served data, shared by every app worker
+After each ingest that publishes a data version, the acquirer writes the DataFrames returned by
+`database.fetch_all_data_as_df` as one `.npy` file per column under `SNAPSHOT_DIR/<version>/`
+and then points `SNAPSHOT_DIR/current` at it. Workers memory-map the files read-only, so they
+share one copy of the pages and load a new version in milliseconds. MongoDB stays the system of
+record: without a snapshot, workers read from it as before.
+"""
+import os
+import json
+import shutil
+import logging
+import tempfile
+import numpy as np
+import pandas as pd
+import utils
+
+SNAPSHOT_DIR = os.environ.get('SNAPSHOT_DIR',
+                              os.path.join(tempfile.gettempdir(), 'covid-tracker-snapshot'))
+SNAPSHOT_KEEP = 2                 # versions kept, so workers still reading the previous one finish
+MANIFEST = 'manifest.json'
+CURRENT = 'current'
+
+logger = logging.Logger(__name__)
+utils.setup_logger(logger, 'snapshot.log')
+
+
+def _path(*names):
+    return os.path.join(SNAPSHOT_DIR, *(str(name) for name in names))
+
+
+def _column_file(geo, name):
+    return '{}.{}.npy'.format(geo, name)
+
+
+def _is_text(column):
+    """Tells whether `column` holds strings, from its dtype or, for an `object` column, from its
+    values, so that an empty one is not taken for text
+    """
+    if isinstance(column.dtype, pd.CategoricalDtype):
+        return True
+    if column.dtype == object:
+        return pd.api.types.infer_dtype(column, skipna=True) == 'string'
+    return pd.api.types.is_string_dtype(column.dtype)
+
+
+def write_snapshot(df_dict, version):
+    """Writes `df_dict` ({geo: DataFrame}) as the snapshot of data `version` and makes it the
+    current one. Strings are stored as category codes with the categories in the manifest, other
+    columns as their NumPy arrays (see `_is_text`). Files are written to a staging directory that is renamed into
+    place, so readers never see a partial snapshot.
+    """
+    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+    staging = tempfile.mkdtemp(dir=SNAPSHOT_DIR, prefix='.staging-')
+    manifest = {'version': version, 'frames': {}}
+    for geo, df in df_dict.items():
+        columns = {}
+        for name in df.columns:
+            column = df[name]
+            if _is_text(column):
+                column = column.astype('category')
+                values = column.cat.codes.to_numpy()
+                columns[name] = {'categories': column.cat.categories.tolist()}
+            else:
+                values = column.infer_objects().to_numpy()
+                if values.dtype == object and len(values) == 0:
+                    # nothing to infer a type from; saved as float rather than pickled objects
+                    values = values.astype(np.float64)
+                columns[name] = {}
+            np.save(os.path.join(staging, _column_file(geo, name)), values, allow_pickle=False)
+        manifest['frames'][geo] = {'rows': len(df), 'columns': columns}
+    with open(os.path.join(staging, MANIFEST), 'w') as f:
+        json.dump(manifest, f)
+    shutil.rmtree(_path(version), ignore_errors=True)
+    os.rename(staging, _path(version))
+    # point `current` at the new version
+    utils.write_atomic(_path(CURRENT), str(version))
+    _prune(version)
+    logger.info('snapshot of data version {} written'.format(version))
+
+
+def _prune(version):
+    """Removes the snapshots of all but the `SNAPSHOT_KEEP` newest versions up to `version`.
+    Workers that still map files of a removed version keep reading them until they let go.
+    """
+    versions = sorted(int(name) for name in os.listdir(SNAPSHOT_DIR) if name.isdigit())
+    for old in [v for v in versions if v <= version][:-SNAPSHOT_KEEP]:
+        shutil.rmtree(_path(old), ignore_errors=True)
+
+
+def current_version():
+    """Returns the version of the current snapshot, or None if none was written yet"""
+    try:
+        with open(_path(CURRENT)) as f:
+            return int(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def load_snapshot(version=None):
+    """Returns the snapshot of data `version` (default: the current one) as {geo: DataFrame}
+    whose columns are read-only memory maps of the snapshot files, or None if there is no such
+    snapshot. The DataFrames must not be modified.
+    """
+    version = current_version() if version is None else version
+    try:
+        with open(_path(version, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None
+    df_dict = {}
+    for geo, frame in manifest['frames'].items():
+        data = {}
+        for name, column in frame['columns'].items():
+            values = np.load(_path(version, _column_file(geo, name)), mmap_mode='r',
+                             allow_pickle=False)
+            if 'categories' in column:
+                values = pd.Categorical.from_codes(values, categories=column['categories'])
+            data[name] = values
+        df_dict[geo] = pd.DataFrame(data, copy=False)
+    return df_dict
@@ -1,9 +1,115 @@
+"""
+Shared helpers and reference data
+The reference tables are bundled in `reference/`: county FIPS codes and names (GeoNames, via the
+geonamescache package) and 2019 Census population estimates of counties and states (as compiled
+by CMU Delphi). They are loaded on first use, then cached as a pickle in `REFERENCE_CACHE_DIR`.
+"""
+import os
 import sys
+import pickle
 import logging
+import tempfile
+import urllib.request
 import numpy as np
 import pandas as pd
+import analytics
 
-fips_code = pd.read_csv('https://raw.githubusercontent.com/cengc13/data1050-final-project/main/data/fips_code.csv', dtype={'fips' : str})
+REFERENCE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'reference')
+REFERENCE_CACHE_DIR = os.environ.get(
+    'REFERENCE_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'covid-tracker'))
+# module attributes loaded on first access, see `reference`
+REFERENCE_NAMES = ['fips_code', 'fips_index', 'fips_state_dict', 'fips_county_dict',
+                   'state_population', 'states']
+REFERENCE_FORMAT = 2              # bump when the cached reference dict changes shape
+
+_reference = None
+
+
+def write_atomic(path, data):
+    """Writes `data` (str or bytes) to a temporary file next to `path`, then renames it over
+    `path`, so that other processes never read a partial file. The directory must exist; the
+    temporary file is removed if writing fails.
+    """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)),
+                               prefix='.' + os.path.basename(path) + '-', suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb' if isinstance(data, bytes) else 'w') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except OSError:
+            pass
+        raise
+
+
+def _write_cache(name, data):
+    """Saves `data` as `name` in `REFERENCE_CACHE_DIR` (see `write_atomic`); a read-only cache
+    directory only costs the speed-up
+    """
+    try:
+        os.makedirs(REFERENCE_CACHE_DIR, exist_ok=True)
+        write_atomic(os.path.join(REFERENCE_CACHE_DIR, name), data)
+    except OSError:
+        pass
+
+
+def _build_reference():
+    fips_code = pd.read_csv(os.path.join(REFERENCE_DIR, 'counties.csv.gz'),
+                            dtype={'county': str, 'state': str, 'population': 'Int64'})
+    fips_code = fips_code.drop_duplicates('fips').reset_index(drop=True)
+    states = pd.read_csv(os.path.join(REFERENCE_DIR, 'states.csv'))
+    # hash index from integer FIPS to the row of `fips_code`, so whole columns resolve in one pass
+    fips_index = pd.Index(fips_code['fips'])
+    fips_code['fips'] = fips_code['fips'].astype(str).str.zfill(5)
+    return {'fips_code': fips_code,
+            'fips_index': fips_index,
+            # plain dicts for scalar lookups
+            'fips_state_dict': dict(zip(fips_index, fips_code['state'])),
+            'fips_county_dict': dict(zip(fips_index, fips_code['county'])),
+            'state_population': pd.Series(states['population'].to_numpy(), index=states['state']),
+            'states': states}
+
+
+def reference():
+    """Returns the reference data as a dict of `REFERENCE_NAMES`, loading it on first use from
+    the pickle cached for the current bundled files, or else from the files themselves
+    """
+    global _reference
+    if _reference is None:
+        stamp = '-'.join('{}-{}'.format(os.stat(path).st_size, os.stat(path).st_mtime_ns)
+                         for path in [os.path.join(REFERENCE_DIR, 'counties.csv.gz'),
+                                      os.path.join(REFERENCE_DIR, 'states.csv')])
+        cache = 'reference-{}-{}.pkl'.format(REFERENCE_FORMAT, stamp)
+        try:
+            with open(os.path.join(REFERENCE_CACHE_DIR, cache), 'rb') as f:
+                _reference = pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            _reference = _build_reference()
+            _write_cache(cache, pickle.dumps(_reference, protocol=pickle.HIGHEST_PROTOCOL))
+    return _reference
+
+
+def __getattr__(name):
+    if name in REFERENCE_NAMES:
+        return reference()[name]
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def fetch_cached(url, name, timeout=None):
+    """Returns the bytes at `url`, downloaded on first use (waiting up to `timeout` seconds for
+    the server) and kept as `name` in `REFERENCE_CACHE_DIR`
+    """
+    try:
+        with open(os.path.join(REFERENCE_CACHE_DIR, name), 'rb') as f:
+            return f.read()
+    except OSError:
+        pass
+    with urllib.request.urlopen(url, timeout=timeout) as response:
+        data = response.read()
+    _write_cache(name, data)
+    return data
 
 def setup_logger(logger, output_file):
     logger.setLevel(logging.INFO)
@@ -34,40 +140,52 @@ all_states = np.array(['Washington', 'Wisconsin', 'Wyoming', 'Illinois', 'Califo
     
 ### The following two utility functions are 
 ### adpated from the kernel by kaggle.com/therealcyberlord
+### and now delegate to the vectorized kernels in `analytics`
 def daily_increase(data):
-    d = []
-    for i in range(len(data)):
-        if i == 0:
-            d.append(data[0])
-        else:
-            d.append(data[i]-data[i-1])
-    return d 
+    return analytics.daily_diff(data).tolist()
 
 def moving_average(data, window_size=7):
-    moving_average = []
-    for i in range(len(data)):
-        if i + window_size < len(data):
-            moving_average.append(np.mean(data[i:i+window_size]))
-        else:
-            moving_average.append(np.mean(data[i:len(data)]))
-    return moving_average
+    return analytics.rolling_mean(data, window_size, align='forward').tolist()
+
+
+
+def _fips_lookup(fips, column):
+    """Maps an array-like of FIPS codes (ints or zero-padded strings) to `column` of `fips_code`
+    through `fips_index`; unknown or missing codes map to 'N/A'
+    """
+    codes = pd.to_numeric(pd.Series(fips), errors='coerce').fillna(-1).astype('int64')
+    rows = reference()['fips_index'].get_indexer(codes)
+    return np.where(rows >= 0, reference()['fips_code'][column].to_numpy()[rows], 'N/A')
 
 
+def fips_to_state(fips):
+    """Vectorized `fip_to_state` over a whole column of FIPS codes"""
+    return _fips_lookup(fips, 'state')
+
+
+def fips_to_county(fips):
+    """Vectorized `fip_to_county` over a whole column of FIPS codes"""
+    return _fips_lookup(fips, 'county')
+
+
+def fips_to_str(fips):
+    """Formats an array-like of integer FIPS codes as the zero-padded 5-digit strings used by
+    county GeoJSON ids
+    """
+    return pd.Series(fips).astype('int64').astype(str).str.zfill(5).to_numpy()
+
 
 def fip_to_state(fip):
-    mask = (fips_code.fips == fip)
-    values = fips_code.loc[mask, 'state'].to_numpy()
-    if len(values) == 0:
+    try:
+        return reference()['fips_state_dict'][int(fip)]
+    except (KeyError, ValueError, TypeError):
         return 'N/A'
-    else:
-        return values[0]
+
 def fip_to_county(fip):
-    mask = (fips_code.fips == fip)
-    values = fips_code.loc[mask, 'county'].to_numpy()
-    if len(values) == 0:
+    try:
+        return reference()['fips_county_dict'][int(fip)]
+    except (KeyError, ValueError, TypeError):
         return 'N/A'
-    else:
-        return values[0]
     
 
 ### US state code
@@ -136,26 +254,104 @@ state_map_dict = {
  'WY': 'Wyoming'
 }
 
-state_code_dict = {v:k for k, v in state_map_dict.items()}
-state_code_dict["Chicago"] = 'Illinois'
+# alternative spellings of codes in `state_map_dict`, and names some sources report as their
+# own jurisdiction, mapped to the canonical code
+CODE_ALIASES = {'D.C.': 'DC'}
+NAME_ALIASES = {'Chicago': 'IL'}
+
+
+class GeoRegistry:
+    """Bidirectional lookups between state names, postal codes and FIPS codes, each a single
+    dict access. Aliases resolve to their canonical entry instead of overwriting it. The plural
+    methods map a whole array-like at once through the same dicts and return arrays.
+    FIPS codes come from the bundled reference data, loaded on first FIPS lookup.
+    """
+    def __init__(self, code_to_name, code_aliases=CODE_ALIASES, name_aliases=NAME_ALIASES):
+        self.code_to_name = {code: name for code, name in code_to_name.items()
+                             if code not in code_aliases}
+        self.name_to_code = {name: code for code, name in self.code_to_name.items()}
+        self.name_to_code.update(name_aliases)
+        # every spelling of a code, for parsing free-form locations
+        self.any_code_to_name = dict(self.code_to_name)
+        self.any_code_to_name.update({alias: self.code_to_name[code]
+                                      for alias, code in code_aliases.items()})
+        self._fips = None
+
+    def code(self, name, default='Others'):
+        try:
+            return self.name_to_code.get(name, default)
+        except TypeError:
+            return default
+
+    def name(self, code, default='Others'):
+        try:
+            return self.code_to_name.get(code, default)
+        except TypeError:
+            return default
+
+    def _fips_maps(self):
+        if self._fips is None:
+            states = reference()['states']
+            code_to_fips = dict(zip(states['code'], states['fips'].astype(int)))
+            self._fips = code_to_fips, {fips: code for code, fips in code_to_fips.items()}
+        return self._fips
+
+    def fips(self, code, default=None):
+        return self._fips_maps()[0].get(code, default)
+
+    def code_of_fips(self, fips, default='Others'):
+        return self._fips_maps()[1].get(fips, default)
+
+    def codes(self, names, default='Others'):
+        return _map(names, self.name_to_code, default)
+
+    def names(self, codes, default='Others'):
+        return _map(codes, self.code_to_name, default)
+
+    def correct_name(self, location):
+        """Returns the state name of a 'City, ST' `location`, or else `location` stripped"""
+        try:
+            return self.any_code_to_name[location.split(',')[-1].strip()]
+        except KeyError:
+            return location.strip()
+        except AttributeError:
+            return location
+
+    def correct_names(self, locations):
+        """Vectorized `correct_name`"""
+        locations = pd.Series(locations, dtype=object).to_numpy()
+        inverse, uniques = pd.factorize(locations)
+        mapped = np.array([self.correct_name(u) for u in uniques] + [None], dtype=object)
+        ret = mapped[inverse]
+        # missing values (position -1) come back as they are, None as None, like `correct_name`
+        missing = inverse == -1
+        ret[missing] = locations[missing]
+        return ret
+
+
+def _map(values, table, default):
+    """Maps each of `values` through dict `table`, `default` when absent or missing. Each
+    distinct value (or category) is looked up once and the results are gathered by position.
+    """
+    values = pd.Series(values)
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        uniques, inverse = values.cat.categories, values.cat.codes.to_numpy()
+    else:
+        inverse, uniques = pd.factorize(values)
+    # the extra last entry is what missing values (position -1) pick
+    mapped = np.array([table.get(u, default) for u in uniques] + [default], dtype=object)
+    return mapped[inverse]
+
+
+geo_registry = GeoRegistry(state_map_dict)
+state_code_dict = geo_registry.name_to_code
+
 
 def correct_state_names(x):
-    try:
-        return state_map_dict[x.split(",")[-1].strip()]
-    except:
-        return x.strip()
+    return geo_registry.correct_name(x)
     
 def get_state_codes(x):
-    try:
-        return state_code_dict[x]
-    except:
-        return "Others"
+    return geo_registry.code(x)
     
 def get_state_name(x):
-    try:
-        for name, code in state_code_dict.items():
-            if code == x:
-                return name
-        return 'Others'
-    except:
-        return "Others"
\ No newline at end of file
+    return geo_registry.name(x)
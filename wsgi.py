@@ -0,0 +1,7 @@
+"""
+WSGI entry point of the dashboard for production servers:
+    gunicorn -c gunicorn.conf.py wsgi:server
+"""
+from app import app
+
+server = app.server